@@ -0,0 +1,224 @@
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.metrics import adjusted_rand_score
+
+from pv_rec.ml_lib import AbstractProductEncoder, ProductShelf, \
+    QuantizedEmbeddings
+
+from structlog import get_logger
+
+
+log=get_logger()
+
+
+def _embeddings_nbytes(embeddings):
+    if isinstance(embeddings, QuantizedEmbeddings):
+        return embeddings.nbytes
+    return embeddings.values.nbytes
+
+
+def benchmark_embedding_precision(products, model_name, clustering,
+                                  embedding_dtypes=("float32", "float16",
+                                                    "int8"),
+                                  quantize_model=(False, True)
+                                  ):
+    """
+    Compare reduced precision embeddings against the float32 baseline.
+
+    Every combination of storage dtype and (int8 dynamic quantized) model is
+    used to embed ``products`` and to fit a ``ProductShelf``. The shelf
+    labels are compared to the float32 labels with the adjusted rand index.
+
+    Parameters
+    ----------
+    products : list
+        Unique product categories
+    model_name : str
+        Name of the SentenceTransformer model
+    clustering : sklearn estimator
+        Clustering used for the product shelf, it is cloned for every run
+    embedding_dtypes : tuple
+        Storage dtypes to compare
+    quantize_model : tuple
+        Whether to run the float32 and/or the int8 quantized model
+
+    Returns
+    -------
+    pd.DataFrame
+        Latency, memory of the embeddings and clustering agreement per
+        variant
+    """
+    results=[]
+    baseline_labels=None
+    for iquantize in quantize_model:
+        encoder=AbstractProductEncoder(products=products,
+                                       model_name=model_name,
+                                       quantize_model=iquantize
+                                       )
+        # load the model before timing, only the inference is compared
+        encoder._load_model()
+
+        start_time=time.time()
+        embeddings=encoder.embedd_it_local(products)
+        latency=time.time() - start_time
+
+        for idtype in embedding_dtypes:
+            encoder.embedding_dtype=idtype
+            iembeddings=encoder._to_output(embeddings.values, products)
+
+            shelf=ProductShelf(clustering=clone(clustering))
+            shelf.fit(iembeddings)
+            ilabels=shelf.cluster_products(iembeddings)
+            if baseline_labels is None:
+                baseline_labels=ilabels
+
+            results.append({
+                "quantized_model": iquantize,
+                "embedding_dtype": idtype,
+                "latency_s": latency,
+                "memory_mb": _embeddings_nbytes(iembeddings) / 1024**2,
+                "adjusted_rand_score": adjusted_rand_score(baseline_labels,
+                                                           ilabels
+                                                           )
+                })
+            log.info("Benchmarked embedding precision", **results[-1])
+
+    return pd.DataFrame(results)
+
+
+def benchmark_streaming_shelf(embeddings, batch_clustering,
+                              streaming_clustering, chunk_size=10000,
+                              sample_size=100000):
+    """
+    Compare a streaming shelf fit against the full batch fit.
+
+    Parameters
+    ----------
+    embeddings : pd.DataFrame or np.ndarray
+        Product embeddings, may be a memory map
+    batch_clustering : sklearn estimator
+        Clustering of the batch fit, e.g. ``KMeans``
+    streaming_clustering : sklearn estimator
+        Clustering with ``partial_fit``, e.g. ``MiniBatchKMeans``
+    chunk_size : int
+        Rows per chunk of the streaming fit
+    sample_size : int
+        Reservoir size for the scaler of the streaming fit
+
+    Returns
+    -------
+    pd.DataFrame
+        Fit time, peak traced memory, inertia in the batch scaled space and
+        agreement with the batch labels
+    """
+    results={}
+    shelves={}
+    for imode, iclustering in [("batch", batch_clustering),
+                               ("streaming", streaming_clustering)]:
+        shelf=ProductShelf(clustering=clone(iclustering),
+                           scaler=clone(ProductShelf().scaler)
+                           )
+        tracemalloc.start()
+        start_time=time.time()
+        if imode=="batch":
+            shelf.fit(pd.DataFrame(np.asarray(embeddings)))
+        else:
+            shelf.fit_streaming(embeddings,
+                                chunk_size=chunk_size,
+                                sample_size=sample_size
+                                )
+        duration=time.time() - start_time
+        _, peak_memory=tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        shelves[imode]=shelf
+        results[imode]={"fit_duration_s": duration,
+                        "peak_memory_mb": peak_memory / 1024**2}
+
+    scaled=shelves["batch"].scaler.transform(np.asarray(embeddings))
+    batch_labels=shelves["batch"].pipeline.predict(np.asarray(embeddings))
+    for imode, ishelf in shelves.items():
+        ilabels=ishelf.pipeline.predict(np.asarray(embeddings))
+        results[imode]["inertia"]=_inertia(scaled, ilabels)
+        results[imode]["adjusted_rand_score"]=adjusted_rand_score(
+            batch_labels, ilabels
+            )
+        log.info("Benchmarked shelf fit", mode=imode, **results[imode])
+
+    return pd.DataFrame(results).T
+
+
+def _inertia(data, labels):
+    inertia=0.
+    for ilabel in np.unique(labels):
+        icluster=data[labels==ilabel]
+        inertia+=((icluster - icluster.mean(axis=0))**2).sum()
+    return inertia
+
+
+def benchmark_product_encoders(encoders, clustering, mastr_data, wlw_data,
+                               test_data):
+    """
+    Compare product encoders by throughput and downstream recall.
+
+    For every encoder the products of all companies are embedded, a
+    ``ProductShelf`` is fitted on them and a ``Recommender`` is fitted on
+    the labeled companies, the recall is computed on ``test_data``.
+
+    Parameters
+    ----------
+    encoders : dict
+        Name -> encoder, e.g. a ``WlwProductEncoder`` and a
+        ``CategoryBagEncoder`` built on the products of all companies
+    clustering : sklearn estimator
+        Clustering of the product shelf, it is cloned for every encoder
+    mastr_data, wlw_data, test_data : pd.DataFrame
+        Company data like ``DataMaster.mastr_data``, ``DataMaster.wlw_data``
+        and ``DataMaster.test_data``
+
+    Returns
+    -------
+    pd.DataFrame
+        Embedding duration, products per second and recall per encoder
+    """
+    # imported here, the recommender pulls in matplotlib and scipy
+    from pv_rec.recommender import Recommender
+
+    results={}
+    for iname, iencoder in encoders.items():
+        start_time=time.time()
+        embeddings=iencoder.embedd_it_local(iencoder.products)
+        duration=time.time() - start_time
+        test_embeddings=iencoder.embedd_it_local(sorted({
+            iproduct for iproducts in test_data.product_categories
+            for iproduct in iproducts
+            }))
+
+        shelf=ProductShelf(clustering=clone(clustering),
+                           scaler=clone(ProductShelf().scaler)
+                           )
+        shelf.fit(embeddings)
+
+        recommender=Recommender()
+        recommender.fit(
+            wlw_data=shelf.append_to_df(wlw_data.copy(), embeddings),
+            mastr_data=shelf.append_to_df(mastr_data.copy(), embeddings)
+            )
+        affinity, _=recommender.recommend(
+            shelf.append_to_df(test_data.copy(), test_embeddings)
+            )
+
+        results[iname]={
+            "embedding_duration_s": duration,
+            "products_per_second": len(iencoder.products) / duration,
+            "recall": recommender.recall(affinity)
+            }
+        log.info("Benchmarked product encoder", encoder=iname,
+                 **results[iname]
+                 )
+
+    return pd.DataFrame(results).T
@@ -0,0 +1,366 @@
+import ast
+import re
+
+import numpy as np
+import pandas as pd
+from pandas.api.extensions import ExtensionArray, ExtensionDtype
+from pandas.api.indexers import check_array_indexer
+from pandas.api.types import is_integer, is_list_like, is_scalar
+
+
+# quoted items of a python set/list literal without escape sequences, as
+# written by repr
+_ITEM=r"""(?:'[^'\\]*'|"[^"\\]*")"""
+_LITERAL_PATTERN=re.compile(
+    rf"\s*[{{\[(]\s*(?:{_ITEM}\s*(?:,\s*{_ITEM}\s*)*,?\s*)?[}}\])]\s*"
+    )
+_ITEM_PATTERN=re.compile(r"'([^'\\]*)'" r'|"([^"\\]*)"')
+_SINGLE_QUOTED_ITEM_PATTERN=re.compile(r"'([^'\\]*)'")
+
+
+class ProductCategoriesDtype(ExtensionDtype):
+    name="product_categories"
+    type=frozenset
+    kind="O"
+    na_value=np.nan
+
+    @classmethod
+    def construct_array_type(cls):
+        return ProductCategoriesArray
+
+
+class ProductCategoriesArray(ExtensionArray):
+    """
+    Product categories of many companies as codes into one vocabulary.
+
+    The categories of all companies are stored back to back as int32 codes
+    into ``vocabulary``, the categories of company ``i`` are
+    ``codes[offsets[i]:offsets[i + 1]]`` (CSR layout). Every category
+    string is stored once, instead of a python set per company.
+
+    Used as a pandas column it behaves like a column of sets, an element is
+    a ``frozenset`` (or NaN for missing values). Hot paths work on
+    ``codes``, ``offsets`` and ``vocabulary`` directly.
+
+    Parameters
+    ----------
+    codes : np.ndarray
+        Codes of the categories of all companies
+    offsets : np.ndarray
+        Start of the codes of every company, plus the end of the last one
+    vocabulary : np.ndarray
+        Category strings, it is shared between arrays and never modified
+    is_missing : np.ndarray, optional
+        Companies without categories (NaN instead of an empty set)
+    """
+    def __init__(self, codes, offsets, vocabulary, is_missing=None):
+        self.codes=np.asarray(codes, dtype=np.int32)
+        self.offsets=np.asarray(offsets, dtype=np.int64)
+        self.vocabulary=np.asarray(vocabulary, dtype=object)
+        if is_missing is None:
+            is_missing=np.zeros(len(self.offsets) - 1, dtype=bool)
+        self.is_missing=np.asarray(is_missing, dtype=bool)
+
+    @classmethod
+    def from_sets(cls, values):
+        """Build the array from an iterable of sets (or NaN)."""
+        lengths=[]
+        items=[]
+        is_missing=[]
+        for ivalues in values:
+            if not is_list_like(ivalues):
+                lengths.append(0)
+                is_missing.append(True)
+                continue
+            iitems=list(ivalues)
+            items.extend(iitems)
+            lengths.append(len(iitems))
+            is_missing.append(False)
+        return cls._from_items(items, lengths, is_missing)
+
+    @classmethod
+    def _from_items(cls, items, lengths, is_missing):
+        codes, vocabulary=pd.factorize(np.asarray(items, dtype=object))
+        lengths=np.asarray(lengths, dtype=np.int64)
+        # a category is kept once per company, at its first position
+        companies=np.repeat(np.arange(len(lengths)), lengths)
+        is_repeated=pd.Index(
+            companies * max(len(vocabulary), 1) + codes
+            ).duplicated()
+        if is_repeated.any():
+            codes=codes[~is_repeated]
+            lengths=np.bincount(companies[~is_repeated],
+                                minlength=len(lengths)
+                                )
+        offsets=np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(codes, offsets, vocabulary, is_missing)
+
+    # %% ExtensionArray interface
+    @classmethod
+    def _from_sequence(cls, scalars, *, dtype=None, copy=False):
+        if isinstance(scalars, cls):
+            return scalars.copy() if copy else scalars
+        return cls.from_sets(scalars)
+
+    @classmethod
+    def _from_factorized(cls, values, original):
+        return cls.from_sets(values)
+
+    @property
+    def dtype(self):
+        return ProductCategoriesDtype()
+
+    @property
+    def lengths(self):
+        """Number of categories of every company."""
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.offsets.nbytes \
+            + self.is_missing.nbytes + self.vocabulary.nbytes
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, item):
+        if is_integer(item):
+            if item < 0:
+                item+=len(self)
+            if self.is_missing[item]:
+                return np.nan
+            return frozenset(self.vocabulary[
+                self.codes[self.offsets[item]:self.offsets[item + 1]]
+                ])
+
+        item=check_array_indexer(self, item)
+        if isinstance(item, slice):
+            return self.take(np.arange(len(self))[item])
+        if item.dtype==bool:
+            return self.take(np.flatnonzero(item))
+        return self.take(item)
+
+    def __setitem__(self, key, value):
+        key=check_array_indexer(self, key)
+        positions=np.atleast_1d(np.arange(len(self))[key])
+        if self._is_element(value):
+            value=type(self).from_sets([value] * len(positions))
+        elif not isinstance(value, ProductCategoriesArray):
+            if not is_list_like(value) or \
+                    not all(self._is_element(ivalue) for ivalue in value):
+                raise TypeError(f"Only sets of categories or missing values "
+                                f"can be set, got {value!r}")
+            value=type(self).from_sets(value)
+        if len(value)!=len(positions):
+            raise ValueError(f"{len(value)} values can not be set to "
+                             f"{len(positions)} positions")
+
+        # the new values are appended and taken to their positions, the
+        # vocabulary is replaced, never changed in place
+        indices=np.arange(len(self))
+        indices[positions]=len(self) + np.arange(len(positions))
+        updated=self._concat_same_type([self, value]).take(indices)
+        self.codes=updated.codes
+        self.offsets=updated.offsets
+        self.vocabulary=updated.vocabulary
+        self.is_missing=updated.is_missing
+
+    @staticmethod
+    def _is_element(value):
+        return isinstance(value, (set, frozenset)) or \
+            (is_scalar(value) and pd.isna(value))
+
+    def __iter__(self):
+        items=self.vocabulary[self.codes]
+        for istart, iend, iis_missing in zip(self.offsets[:-1],
+                                             self.offsets[1:],
+                                             self.is_missing):
+            yield np.nan if iis_missing else frozenset(items[istart:iend])
+
+    def __array__(self, dtype=None, copy=None):
+        values=np.empty(len(self), dtype=object)
+        values[:]=list(self)
+        return values
+
+    def __eq__(self, other):
+        if isinstance(other, (pd.Series, pd.Index, pd.DataFrame)):
+            return NotImplemented
+        if is_list_like(other) and not isinstance(other, (set, frozenset)):
+            return np.array([ivalue==iother for ivalue, iother
+                             in zip(self, other)], dtype=bool)
+        return np.array([ivalue==other for ivalue in self], dtype=bool)
+
+    def isna(self):
+        return self.is_missing.copy()
+
+    def copy(self):
+        return type(self)(self.codes.copy(), self.offsets.copy(),
+                          self.vocabulary, self.is_missing.copy()
+                          )
+
+    def take(self, indices, allow_fill=False, fill_value=None):
+        indices=np.asarray(indices, dtype=np.intp)
+        is_fill=np.zeros(len(indices), dtype=bool)
+        if allow_fill:
+            if is_list_like(fill_value) or not pd.isna(fill_value):
+                raise ValueError("Only missing values can be filled in")
+            if (indices < -1).any():
+                raise ValueError("Invalid value in indices, use -1 for "
+                                 "missing values")
+            is_fill=indices==-1
+
+        positions=indices[~is_fill]
+        if ((positions >= len(self)) | (positions < -len(self))).any():
+            raise IndexError("Index out of bounds")
+        positions=np.where(positions < 0, positions + len(self), positions)
+
+        lengths=np.zeros(len(indices), dtype=np.int64)
+        lengths[~is_fill]=self.lengths[positions]
+        starts=np.zeros(len(indices), dtype=np.int64)
+        starts[~is_fill]=self.offsets[positions]
+        offsets=np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # position of every taken code in self.codes
+        code_positions=np.repeat(starts - offsets[:-1], lengths) \
+            + np.arange(offsets[-1])
+
+        is_missing=is_fill.copy()
+        is_missing[~is_fill]=self.is_missing[positions]
+        return type(self)(self.codes[code_positions], offsets,
+                          self.vocabulary, is_missing
+                          )
+
+    @classmethod
+    def _concat_same_type(cls, to_concat):
+        to_concat=list(to_concat)
+        vocabulary=to_concat[0].vocabulary
+        codes=[]
+        if all(iarray.vocabulary is vocabulary for iarray in to_concat):
+            codes=[iarray.codes for iarray in to_concat]
+        else:
+            vocabulary=pd.unique(np.concatenate(
+                [iarray.vocabulary for iarray in to_concat]
+                ))
+            vocabulary_index=pd.Index(vocabulary)
+            for iarray in to_concat:
+                icode_map=vocabulary_index.get_indexer(iarray.vocabulary)
+                codes.append(icode_map[iarray.codes])
+
+        lengths=np.concatenate([iarray.lengths for iarray in to_concat])
+        offsets=np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(np.concatenate(codes), offsets, vocabulary,
+                   np.concatenate([iarray.is_missing for iarray in to_concat])
+                   )
+
+    def _explode(self):
+        # empty and missing rows explode to one NaN like lists do
+        counts=np.maximum(self.lengths, 1)
+        offsets=np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        values=np.full(offsets[-1], np.nan, dtype=object)
+        values[np.repeat(offsets[:-1] - self.offsets[:-1], self.lengths)
+               + np.arange(len(self.codes))]=self.vocabulary[self.codes]
+        return values, counts.astype(np.uint64)
+
+    def _groupby_op(self, *, how, has_dropped_na, min_count, ngroups, ids,
+                    **kwargs):
+        if how not in ("first", "last"):
+            return super()._groupby_op(how=how,
+                                       has_dropped_na=has_dropped_na,
+                                       min_count=min_count,
+                                       ngroups=ngroups,
+                                       ids=ids,
+                                       **kwargs
+                                       )
+        is_valid=ids >= 0
+        if kwargs.get("skipna", True):
+            is_valid&=~self.is_missing
+        positions=np.flatnonzero(is_valid)
+        if how=="first":
+            # the last write wins, write in reverse to keep the first row
+            positions=positions[::-1]
+        group_positions=np.full(ngroups, -1, dtype=np.intp)
+        group_positions[ids[positions]]=positions
+        return self.take(group_positions, allow_fill=True)
+
+    # %% category helpers
+    def unique_categories(self):
+        """Categories that occur in the array, in order of appearance."""
+        return self.vocabulary[pd.unique(self.codes)]
+
+    def company_positions(self):
+        """Position of the company of every code."""
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+
+def unique_categories(product_categories):
+    """
+    Unique categories of a column of category sets in order of appearance.
+    Missing values and empty sets give a NaN entry, like ``explode``.
+    """
+    if isinstance(product_categories.values, ProductCategoriesArray):
+        categories=product_categories.values
+        unique=list(categories.unique_categories())
+        if (categories.lengths==0).any():
+            unique.append(np.nan)
+        return unique
+    return list(product_categories.explode().unique())
+
+
+def parse_product_categories(values):
+    """
+    Parse the string representation of the product category sets.
+
+    The quoted items of every literal are matched with a regular
+    expression, only literals with escaped characters or other items than
+    strings fall back to ``ast.literal_eval``. Repeated items are kept
+    once. ``frozenset({...})`` (as written by ``to_csv``) is read like a
+    set literal. Values that are not strings are missing.
+
+    Parameters
+    ----------
+    values : pd.Series
+        Strings like ``"{'Solartechnik', 'Baumaschinen'}"``
+
+    Returns
+    -------
+    pd.Series
+        ``ProductCategoriesArray`` with the index of ``values``
+    """
+    lengths=np.zeros(len(values), dtype=np.int64)
+    is_missing=np.zeros(len(values), dtype=bool)
+    items=[]
+    for irow, itext in enumerate(values):
+        if not isinstance(itext, str):
+            is_missing[irow]=True
+            continue
+        iitems=_parse_literal(itext)
+        items.extend(iitems)
+        lengths[irow]=len(iitems)
+
+    categories=ProductCategoriesArray._from_items(items, lengths, is_missing)
+    return pd.Series(categories, index=values.index, name=values.name)
+
+
+def _parse_literal(text):
+    text=text.strip()
+    if text.startswith("frozenset(") and text.endswith(")"):
+        # to_csv writes the elements of a ProductCategoriesArray as
+        # frozenset literals
+        text=text[len("frozenset("):-1].strip() or "set()"
+
+    if _LITERAL_PATTERN.fullmatch(text) is None:
+        if text=="set()":
+            return []
+        return list(ast.literal_eval(text))
+
+    if '"' in text:
+        items=[isingle or idouble
+               for isingle, idouble in _ITEM_PATTERN.findall(text)]
+    else:
+        items=_SINGLE_QUOTED_ITEM_PATTERN.findall(text)
+    # repeated items, also in set literals like "{'a', 'a'}", are removed
+    # for all rows at once in ProductCategoriesArray._from_items
+    return items
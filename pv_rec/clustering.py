@@ -0,0 +1,161 @@
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+
+def ward_linkage(data, sample_weight=None):
+    """
+    Ward linkage computed on the feature vectors with a nearest-neighbor
+    chain.
+
+    ``scipy.cluster.hierarchy.linkage`` builds the condensed distance
+    matrix, which needs O(n²) memory. Here only the centroids and sizes of
+    the active clusters are kept (O(n·d) memory), the ward distance between
+    two clusters is
+
+        sqrt(2 * n_a * n_b / (n_a + n_b)) * ||c_a - c_b||
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Feature vectors of shape (n_samples, n_features)
+    sample_weight : np.ndarray, optional
+        Initial size of every row, e.g. the number of companies a
+        micro-cluster centroid stands for. Defaults to 1 for every row.
+
+    Returns
+    -------
+    np.ndarray
+        Linkage matrix in the format of ``scipy.cluster.hierarchy.linkage``,
+        the weights only enter the distances, the last column counts rows
+        like scipy does
+    """
+    centroids=np.array(data, dtype=np.float64)
+    num_samples=len(centroids)
+    if num_samples < 2:
+        raise ValueError("At least two samples are needed for a linkage")
+    if sample_weight is None:
+        sizes=np.ones(num_samples)
+    else:
+        sizes=np.array(sample_weight, dtype=np.float64)
+
+    is_active=np.ones(num_samples, dtype=bool)
+    merges=np.empty((num_samples - 1, 3))
+    chain=[]
+    num_merges=0
+    while num_merges < num_samples - 1:
+        if not chain:
+            chain.append(int(np.argmax(is_active)))
+
+        cluster_a=chain[-1]
+        distances=_ward_distances(centroids, sizes, cluster_a)
+        distances[~is_active]=np.inf
+        distances[cluster_a]=np.inf
+        cluster_b=int(np.argmin(distances))
+        # prefer the predecessor on ties, otherwise the chain can cycle
+        if len(chain) > 1 and \
+                distances[chain[-2]]==distances[cluster_b]:
+            cluster_b=chain[-2]
+
+        if len(chain) > 1 and cluster_b==chain[-2]:
+            chain=chain[:-2]
+            merges[num_merges]=(cluster_a, cluster_b,
+                                np.sqrt(distances[cluster_b])
+                                )
+            num_merges+=1
+
+            # the merged cluster lives on in the slot of cluster_b
+            merged_size=sizes[cluster_a] + sizes[cluster_b]
+            centroids[cluster_b]=(sizes[cluster_a] * centroids[cluster_a]
+                                  + sizes[cluster_b] * centroids[cluster_b]) \
+                / merged_size
+            sizes[cluster_b]=merged_size
+            is_active[cluster_a]=False
+        else:
+            chain.append(cluster_b)
+
+    return _label_merges(merges)
+
+
+def _ward_distances(centroids, sizes, cluster):
+    """Squared ward distances of ``cluster`` to all clusters."""
+    squared_distances=((centroids - centroids[cluster])**2).sum(axis=1)
+    return 2 * sizes * sizes[cluster] / (sizes + sizes[cluster]) \
+        * squared_distances
+
+
+def _label_merges(merges):
+    """
+    Sort the merges by distance and translate the slots into the cluster
+    ids of a scipy linkage matrix (original samples 0..n-1, the i-th merge
+    gets the id n+i).
+    """
+    num_samples=len(merges) + 1
+    parent=np.arange(2 * num_samples - 1)
+    sizes=np.concatenate([np.ones(num_samples), np.zeros(num_samples - 1)])
+
+    def find(cluster):
+        root=cluster
+        while parent[root]!=root:
+            root=parent[root]
+        while parent[cluster]!=root:
+            parent[cluster], cluster=root, parent[cluster]
+        return root
+
+    linkage_matrix=np.empty((num_samples - 1, 4))
+    for imerge, (islot_a, islot_b, idistance) in enumerate(
+            merges[np.argsort(merges[:, 2], kind="stable")]):
+        iroot_a=find(int(islot_a))
+        iroot_b=find(int(islot_b))
+        inew_cluster=num_samples + imerge
+
+        parent[iroot_a]=inew_cluster
+        parent[iroot_b]=inew_cluster
+        sizes[inew_cluster]=sizes[iroot_a] + sizes[iroot_b]
+        linkage_matrix[imerge]=(min(iroot_a, iroot_b),
+                                max(iroot_a, iroot_b),
+                                idistance,
+                                sizes[inew_cluster]
+                                )
+    return linkage_matrix
+
+
+def micro_cluster(data, n_clusters, batch_size=4096, random_state=None):
+    """
+    Compress the rows of ``data`` into micro-clusters with mini-batch
+    k-means.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Feature vectors of shape (n_samples, n_features)
+    n_clusters : int
+        Number of micro-clusters, capped at the number of samples
+    batch_size : int
+        Batch size of the mini-batch k-means
+    random_state : int, optional
+        Seed of the k-means
+
+    Returns
+    -------
+    labels : np.ndarray
+        Micro-cluster of every row, numbered 0..n_micro_clusters-1
+    centroids : np.ndarray
+        Mean of the rows of every micro-cluster
+    weights : np.ndarray
+        Number of rows in every micro-cluster
+    """
+    n_clusters=min(n_clusters, len(data))
+    kmeans=MiniBatchKMeans(n_clusters=n_clusters,
+                           batch_size=batch_size,
+                           n_init=3,
+                           random_state=random_state
+                           )
+    labels=kmeans.fit_predict(data)
+
+    # drop empty clusters and use the exact means of the assigned rows
+    used_clusters, labels=np.unique(labels, return_inverse=True)
+    weights=np.bincount(labels)
+    centroids=np.zeros((len(used_clusters), data.shape[1]))
+    np.add.at(centroids, labels, data)
+    centroids/=weights[:, None]
+    return labels, centroids, weights
@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import infer_dtype
+
+from structlog import get_logger
+
+from pv_rec.categories import ProductCategoriesArray
+
+
+log=get_logger()
+
+# inferred types of object columns that can be stored as codes + vocabulary
+_VOCABULARY_TYPES={"string", "boolean", "integer", "floating", "empty"}
+
+
+def hash_files(filepaths, version, block_size=2**20):
+    """sha256 over the content of ``filepaths`` and the ``version``."""
+    content_hash=hashlib.sha256(str(version).encode("utf-8"))
+    for ifilepath in filepaths:
+        with open(ifilepath, "rb") as file:
+            for iblock in iter(lambda: file.read(block_size), b""):
+                content_hash.update(iblock)
+        # separates the files, "ab" + "c" and "a" + "bc" differ
+        content_hash.update(b"\0")
+    return content_hash.hexdigest()
+
+
+def frame_to_arrays(data: pd.DataFrame):
+    """
+    Encode a frame as plain numpy arrays and a json serializable schema.
+
+    Numeric and bool columns are stored as they are. Object columns are
+    stored as int32 codes into a vocabulary of their unique values, columns
+    of sets as one code array of all items plus the row offsets into it
+    (CSR layout). Missing values get the code -1. ``ProductCategoriesArray``
+    columns already have that layout, their arrays are stored directly.
+    """
+    arrays={}
+    schema={"columns": [], "index_name": data.index.name}
+    arrays["index"]=_vocabulary_array(data.index.values)
+
+    for jcolumn, icolumn in enumerate(data.columns):
+        ivalues=data[icolumn]
+        iname=f"column_{jcolumn}"
+        if isinstance(ivalues.values, ProductCategoriesArray):
+            arrays.update(_encode_categories(iname, ivalues.values))
+            ikind="categories"
+        elif ivalues.dtype!=object:
+            arrays[iname]=ivalues.to_numpy()
+            ikind="array"
+        elif _is_set_column(ivalues):
+            arrays.update(_encode_sets(iname, ivalues))
+            ikind="sets"
+        else:
+            codes, vocabulary=pd.factorize(ivalues)
+            arrays[f"{iname}_codes"]=codes.astype(np.int32)
+            arrays[f"{iname}_vocabulary"]=_vocabulary_array(vocabulary)
+            ikind="codes"
+        schema["columns"].append({"name": icolumn, "kind": ikind})
+    return arrays, schema
+
+
+def arrays_to_frame(arrays, schema):
+    """Inverse of ``frame_to_arrays``."""
+    columns={}
+    for jcolumn, icolumn in enumerate(schema["columns"]):
+        iname=f"column_{jcolumn}"
+        if icolumn["kind"]=="array":
+            columns[icolumn["name"]]=arrays[iname]
+        elif icolumn["kind"]=="categories":
+            columns[icolumn["name"]]=ProductCategoriesArray(
+                arrays[f"{iname}_codes"],
+                arrays[f"{iname}_offsets"],
+                arrays[f"{iname}_vocabulary"],
+                arrays[f"{iname}_missing"]
+                )
+        elif icolumn["kind"]=="sets":
+            columns[icolumn["name"]]=_decode_sets(iname, arrays)
+        else:
+            columns[icolumn["name"]]=_decode_codes(
+                arrays[f"{iname}_codes"],
+                arrays[f"{iname}_vocabulary"]
+                )
+    index=pd.Index(arrays["index"].astype(object), name=schema["index_name"])
+    return pd.DataFrame(columns, index=index)
+
+
+def _vocabulary_array(values):
+    if infer_dtype(values, skipna=False) not in _VOCABULARY_TYPES:
+        raise TypeError(f"Values of type {infer_dtype(values)} can not be "
+                        f"stored in the data cache")
+    return np.asarray(values.tolist() if hasattr(values, "tolist")
+                      else list(values))
+
+
+def _is_set_column(values):
+    first_values=values.dropna()
+    return len(first_values) > 0 and \
+        isinstance(first_values.iloc[0], (set, frozenset))
+
+
+def _encode_sets(name, values):
+    is_missing=values.isna().values
+    item_sets=values.where(~is_missing, other=None)
+    lengths=np.fromiter((0 if iset is None else len(iset)
+                         for iset in item_sets),
+                        dtype=np.int64,
+                        count=len(values)
+                        )
+    offsets=np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    items=[iitem for iset in item_sets if iset is not None
+           for iitem in sorted(iset)]
+    codes, vocabulary=pd.factorize(pd.Series(items, dtype=object))
+    return {f"{name}_codes": codes.astype(np.int32),
+            f"{name}_offsets": offsets,
+            f"{name}_missing": is_missing,
+            f"{name}_vocabulary": _vocabulary_array(vocabulary)
+            }
+
+
+def _encode_categories(name, categories):
+    return {f"{name}_codes": categories.codes,
+            f"{name}_offsets": categories.offsets,
+            f"{name}_missing": categories.is_missing,
+            f"{name}_vocabulary": _vocabulary_array(categories.vocabulary)
+            }
+
+
+def _decode_sets(name, arrays):
+    vocabulary=arrays[f"{name}_vocabulary"].astype(object)
+    items=vocabulary[arrays[f"{name}_codes"]]
+    offsets=arrays[f"{name}_offsets"]
+    item_sets=np.empty(len(offsets) - 1, dtype=object)
+    item_sets[:]=[set(items[istart:iend])
+                  for istart, iend in zip(offsets[:-1], offsets[1:])]
+    item_sets[arrays[f"{name}_missing"]]=np.nan
+    return item_sets
+
+
+def _decode_codes(codes, vocabulary):
+    # one slot more for the missing values (code -1)
+    lookup=np.append(vocabulary.astype(object), np.nan)
+    return lookup[codes]
+
+
+class PreprocessedDataCache:
+    """
+    On-disk cache of preprocessed frames, one directory per key.
+
+    Every frame is written as an uncompressed npz file (one or more arrays
+    per column, see ``frame_to_arrays``) next to a json file with its
+    schema. The key is usually the ``hash_files`` of the input files and
+    the pipeline version, changed inputs therefore miss the cache.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Root directory of the cache
+    """
+    schema_file="schema.json"
+
+    def __init__(self, cache_dir):
+        self.cache_dir=cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def load(self, key):
+        """Cached frames of ``key`` or None."""
+        schema_path=os.path.join(self.cache_dir, key, self.schema_file)
+        if not os.path.exists(schema_path):
+            return None
+        with open(schema_path, encoding="utf-8") as file:
+            schemas=json.load(file)
+
+        frames={}
+        for iname, ischema in schemas.items():
+            with np.load(self._path(key, iname),
+                         allow_pickle=False) as arrays:
+                frames[iname]=arrays_to_frame(arrays, ischema)
+        return frames
+
+    def save(self, key, frames):
+        """Store the frames (name -> DataFrame) under ``key``."""
+        try:
+            encoded={iname: frame_to_arrays(iframe)
+                     for iname, iframe in frames.items()}
+        except TypeError as error:
+            log.warning("Data can not be cached", error=str(error))
+            return
+
+        os.makedirs(os.path.join(self.cache_dir, key), exist_ok=True)
+        for iname, (iarrays, _) in encoded.items():
+            np.savez(self._path(key, iname), **iarrays)
+        # the schema is written last, it marks the entry as complete
+        schema_path=os.path.join(self.cache_dir, key, self.schema_file)
+        with open(schema_path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump({iname: ischema
+                       for iname, (_, ischema) in encoded.items()}, file)
+        os.replace(schema_path + ".tmp", schema_path)
+
+    def _path(self, key, name):
+        return os.path.join(self.cache_dir, key, f"{name}.npz")
@@ -1,44 +1,145 @@
-import ast
-from dataclasses import asdict, dataclass
+from dataclasses import dataclass, field, fields
 
 import pandas as pd
+from pandas.api.types import (is_bool_dtype, is_numeric_dtype,
+                              is_object_dtype, is_string_dtype)
+
+from pv_rec.categories import ProductCategoriesDtype, parse_product_categories
+
+
+def _is_text_dtype(dtype):
+    return is_object_dtype(dtype) or is_string_dtype(dtype)
+
+
+def _is_int_castable_dtype(dtype):
+    # astype(int) also parses strings of digits
+    return is_numeric_dtype(dtype) or _is_text_dtype(dtype)
+
+
+def _is_categories_dtype(dtype):
+    return isinstance(dtype, ProductCategoriesDtype) or _is_text_dtype(dtype)
+
+
+def _is_flag_dtype(dtype):
+    # bool, 0/1 or object columns, the default ingestion keeps the flags as
+    # object columns. Their values are not checked
+    return is_bool_dtype(dtype) or is_numeric_dtype(dtype) or \
+        is_object_dtype(dtype)
+
+
+# accepted dtypes of the raw columns that are taken as they are, fields
+# with a parse function name the accepted dtypes in their metadata
+_DTYPE_CHECKS={
+    str: _is_text_dtype,
+    int: is_numeric_dtype,
+    float: is_numeric_dtype,
+    bool: _is_flag_dtype,
+}
+
+
+def _to_int(values):
+    return values.astype(int)
+
+
+def _to_product_categories(values):
+    if isinstance(values.dtype, ProductCategoriesDtype):
+        return values
+    return parse_product_categories(values)
 
 
 @dataclass
 class DataclassWlwData:
+    """
+    Schema of the parsed WLW data.
+
+    The metadata of every field holds the name of its raw ``column``. Fields
+    with a ``parse`` function also name the raw dtypes it ``accepts``, all
+    other columns are taken as they are.
+    """
     #company_street: str
     #company_zip: int
     #company_city: str
-    distribution_area: str
-    founding_year: int
-    employee_count: str
-    product_categories: set[str]
-    is_producer: bool = False
-    is_serviceprovider: bool = False
-    is_wholesales: bool = False
-    is_sales: bool = False
-    num_modules: int = None
-    installed_power: float = None
+    distribution_area: str = field(metadata={"column": "distribution-area"})
+    founding_year: int = field(metadata={"column": "founding-year",
+                                         "parse": _to_int,
+                                         "accepts": _is_int_castable_dtype})
+    employee_count: str = field(metadata={"column": "employee-count"})
+    product_categories: frozenset[str] = field(
+        metadata={"column": "product_categories",
+                  "parse": _to_product_categories,
+                  "accepts": _is_categories_dtype}
+        )
+    is_producer: bool = field(default=False,
+                              metadata={"column": "Hersteller/Fabrikant"})
+    is_serviceprovider: bool = field(default=False,
+                                     metadata={"column": "Dienstleister"})
+    is_wholesales: bool = field(default=False,
+                                metadata={"column": "Großhändler"})
+    is_sales: bool = field(default=False, metadata={"column": "Lieferant"})
+    num_modules: int = field(default=None,
+                             metadata={"column": "Anzahl Module"})
+    installed_power: float = field(default=None,
+                                   metadata={"column": "Leistung"})
     # latitude: float = None
     # longitude: float = None
 
 
+def _accepts_dtype(schema_field, dtype):
+    check=schema_field.metadata.get("accepts",
+                                    _DTYPE_CHECKS.get(schema_field.type)
+                                    )
+    return check(dtype)
+
+
+def validate_schema(data, schema=DataclassWlwData):
+    """
+    Check that ``data`` has the raw columns of ``schema`` with usable dtypes.
+
+    Only the dtypes are checked, not the values, the check therefore does
+    not depend on the number of rows. Object columns pass for flags, values
+    that can not be parsed fail in ``parse_wlw_data``.
+
+    Raises
+    ------
+    KeyError
+        If raw columns are missing, all of them are listed
+    TypeError
+        If raw columns have a dtype that does not fit their field
+    """
+    columns={ifield.metadata["column"]: ifield for ifield in fields(schema)}
+    missing_columns=[icolumn for icolumn in columns
+                     if icolumn not in data.columns]
+    if missing_columns:
+        raise KeyError(f"{schema.__name__} misses the columns "
+                       f"{missing_columns}")
+
+    dtypes=data.dtypes
+    wrong_dtypes={icolumn: str(dtypes[icolumn])
+                  for icolumn, ifield in columns.items()
+                  if not _accepts_dtype(ifield, dtypes[icolumn])}
+    if wrong_dtypes:
+        raise TypeError(f"{schema.__name__} can not parse the columns "
+                        f"with the dtypes {wrong_dtypes}")
+
+
 def parse_wlw_data(data, **kwargs):
-    parsed_data = DataclassWlwData(
-        #company_street=data.company_street,
-        #company_zip=data.company_zip.astype(int),
-        #company_city=data.company_city,
-        distribution_area=data["distribution-area"],
-        founding_year=data["founding-year"].astype(int),
-        employee_count=data["employee-count"],
-        product_categories=data["product_categories"].apply(ast.literal_eval),
-        is_producer=data['Hersteller/Fabrikant'],
-        is_serviceprovider=data['Dienstleister'],
-        is_wholesales=data['Großhändler'],
-        is_sales=data["Lieferant"],
-        num_modules=data["Anzahl Module"],
-        installed_power=data["Leistung"],
-        # latitude=data["Breitengrad"],
-        # longitude=data["Längengrad"]
-    )
-    return pd.DataFrame.from_dict(asdict(parsed_data))
+    """
+    Select and rename the raw columns of ``DataclassWlwData``.
+
+    The columns without a parse function are the columns of ``data``, they
+    are not copied. Changing them in place changes ``data`` too. A
+    ValueError names the column whose values can not be parsed.
+    """
+    validate_schema(data, DataclassWlwData)
+    parsed_data={}
+    for ifield in fields(DataclassWlwData):
+        icolumn=ifield.metadata["column"]
+        ivalues=data[icolumn]
+        if "parse" in ifield.metadata:
+            try:
+                ivalues=ifield.metadata["parse"](ivalues)
+            except (TypeError, ValueError) as error:
+                raise ValueError(f"Column {icolumn} can not be parsed into "
+                                 f"{ifield.name}: {error}") from error
+        parsed_data[ifield.name]=ivalues
+    return pd.DataFrame(parsed_data, copy=False)
@@ -1,11 +1,57 @@
 from abc import ABCMeta
 
 from pv_rec import data_classes
+from pv_rec.data_cache import PreprocessedDataCache, hash_files
 from pv_rec.ml_lib import WlwProductEncoder
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import is_string_dtype
+from structlog import get_logger
 pd.set_option('future.no_silent_downcasting', True)
 
+log=get_logger()
+
+# bump when the preprocessing changes, invalidates the cached data
+PIPELINE_VERSION=3
+
+MASTR_AGGREGATIONS={
+    'distribution_area': 'max',
+    'employee_count': 'max',
+    'founding_year': 'min',
+    'installed_power': 'mean',
+    'is_producer': 'max',
+    'is_sales': 'max',
+    'is_serviceprovider': 'max',
+    'is_wholesales': 'max',
+    'num_modules': 'mean',
+    'product_categories': 'first',
+    }
+
+# columns of the Mastr export the pipeline uses and their dtypes
+MASTR_DTYPES={
+    'company_name': str,
+    'company_street': str,
+    'company_zip': 'float64',
+    'company_city': str,
+    'distribution-area': str,
+    'founding-year': 'float64',
+    'employee-count': str,
+    'product_categories': str,
+    'Hersteller/Fabrikant': 'boolean',
+    'Dienstleister': 'boolean',
+    'Großhändler': 'boolean',
+    'Lieferant': 'boolean',
+    'Anzahl Module': 'float64',
+    'Leistung': 'float64',
+    }
+
+SOLAR_ERROR_PLACEHOLDERS=[
+    "no close roof found",
+    "'NoneType' object has no attribute 'latitude'",
+    "more than 1 roof object found"
+    ]
+
 class WlwDataUtility(metaclass=ABCMeta):
     @staticmethod
     def _get_fill_values():
@@ -97,18 +143,54 @@ class WlwPipeline(WlwDataUtility):
 
 
 class DataMaster:
+    """
+    Loads and preprocesses the Mastr, solar and WLW data.
+
+    With a ``cache_dir`` the preprocessed ``mastr_data`` and ``wlw_data``
+    are cached. The cache key is the content hash of the three input files
+    and ``PIPELINE_VERSION``, bump the version whenever the preprocessing
+    changes.
+    """
     def __init__(self,
                  mastr_filepath: str,
                  solar_filepath: str,
-                 wlw_filepath: str):
-        self.mastr_data = self.load_mastr_data(filepath=mastr_filepath)
-        self.wlw_data = self.load_wlw_data(filepath=wlw_filepath,
-                                           solar_filepath=solar_filepath)
+                 wlw_filepath: str,
+                 cache_dir: str=None,
+                 mastr_chunksize: int=None):
+        cache=None
+        cached_data=None
+        if cache_dir is not None:
+            cache=PreprocessedDataCache(cache_dir)
+            # the chunked ingestion yields bool instead of object flags
+            cache_key=hash_files(
+                [mastr_filepath, solar_filepath, wlw_filepath],
+                PIPELINE_VERSION if mastr_chunksize is None
+                else f"{PIPELINE_VERSION}-chunked"
+                )
+            cached_data=cache.load(cache_key)
+
+        if cached_data is not None:
+            log.info("Loading preprocessed data from cache", key=cache_key)
+            self.mastr_data = cached_data["mastr_data"]
+            self.wlw_data = cached_data["wlw_data"]
+        else:
+            self.mastr_data = self.load_mastr_data(
+                filepath=mastr_filepath, chunksize=mastr_chunksize
+                )
+            self.wlw_data = self.load_wlw_data(filepath=wlw_filepath,
+                                               solar_filepath=solar_filepath)
+            if cache is not None:
+                cache.save(cache_key, {"mastr_data": self.mastr_data,
+                                       "wlw_data": self.wlw_data
+                                       })
         self.test_data = None
 
     # %% Mastr Data
     @staticmethod
-    def load_mastr_data(filepath: str):
+    def load_mastr_data(filepath: str, chunksize: int=None):
+        if chunksize is not None:
+            return DataMaster.load_mastr_data_chunked(filepath, chunksize)
+
         mastr_data=pd.read_csv(filepath, index_col=0)
 
         data_pipeline=WlwPipeline(mastr_data)
@@ -138,52 +220,175 @@ class DataMaster:
             Dataframe with aggregated mastr data
 
         """
-        agg_dict= \
-            {
-                'distribution_area': 'max',
-                'employee_count': 'max',
-                'founding_year': 'min',
-                'installed_power': 'mean',
-                'is_producer': 'max',
-                'is_sales': 'max',
-                'is_serviceprovider': 'max',
-                'is_wholesales': 'max',
-                'num_modules': 'mean',
-                'product_categories': 'first',
-                }
-        mastr_data=mastr_data.groupby(level=0).agg(agg_dict)
+        mastr_data=mastr_data.groupby(level=0).agg(MASTR_AGGREGATIONS)
         return mastr_data
 
+    @staticmethod
+    def load_mastr_data_chunked(filepath: str, chunksize: int=100000):
+        """
+        Streaming version of ``load_mastr_data`` for large Mastr exports.
+
+        Only the used columns are read, with explicit dtypes, ``chunksize``
+        rows at a time. Every chunk is preprocessed and reduced to partial
+        aggregates per company (max, min, sum and count for the means,
+        first), which are merged with the aggregates of the previous
+        chunks. The memory is bounded by the chunk size and the number of
+        distinct companies, not by the size of the file.
+
+        The result is the same as with ``load_mastr_data``, except that the
+        ``is_*`` flags are bool instead of object columns.
+
+        Parameters
+        ----------
+        filepath : str
+            Mastr data in WLW style
+        chunksize : int
+            Number of rows per chunk
+
+        Returns
+        -------
+        pd.DataFrame
+            Preprocessed Mastr data, one row per company
+        """
+        header=pd.read_csv(filepath, nrows=0)
+        usecols=[header.columns[0]] + [icolumn for icolumn in MASTR_DTYPES
+                                       if icolumn in header.columns]
+        dtypes={icolumn: idtype for icolumn, idtype in MASTR_DTYPES.items()
+                if icolumn in usecols}
+
+        partial_aggregations={}
+        for icolumn, iaggregation in MASTR_AGGREGATIONS.items():
+            if iaggregation=='mean':
+                partial_aggregations[f"{icolumn}_sum"]=(icolumn, 'sum')
+                partial_aggregations[f"{icolumn}_count"]=(icolumn, 'count')
+            else:
+                partial_aggregations[icolumn]=(icolumn, iaggregation)
+        # sums and counts of the chunks add up, the others merge as they are
+        merge_aggregations={
+            icolumn: (icolumn, 'sum' if iaggregation in ('sum', 'count')
+                      else iaggregation)
+            for icolumn, (_, iaggregation) in partial_aggregations.items()
+            }
+
+        # partial aggregates are merged once they outgrow the merged ones,
+        # the earlier chunks always come first, which keeps 'first'
+        aggregated=[]
+        num_pending_rows=0
+        num_rows=0
+        for ichunk in pd.read_csv(filepath, index_col=0, usecols=usecols,
+                                  dtype=dtypes, chunksize=chunksize):
+            num_rows+=len(ichunk)
+            data_pipeline=WlwPipeline(ichunk)
+            data_pipeline.transform()
+            aggregated.append(DataMaster._aggregate_companies(
+                data_pipeline.data, partial_aggregations
+                ))
+            num_pending_rows+=len(aggregated[-1])
+            if len(aggregated) > 1 and \
+                    num_pending_rows >= len(aggregated[0]):
+                aggregated=[DataMaster._aggregate_companies(
+                    pd.concat(aggregated), merge_aggregations
+                    )]
+                num_pending_rows=0
+        aggregated=DataMaster._aggregate_companies(pd.concat(aggregated),
+                                                   merge_aggregations
+                                                   )
+        log.info("Mastr data read", num_rows=num_rows,
+                 num_companies=len(aggregated)
+                 )
+
+        for icolumn, iaggregation in MASTR_AGGREGATIONS.items():
+            if iaggregation=='mean':
+                aggregated[icolumn]=aggregated.pop(f"{icolumn}_sum") \
+                    / aggregated.pop(f"{icolumn}_count").replace(0, np.nan)
+        for icolumn in ['is_producer', 'is_sales', 'is_serviceprovider',
+                        'is_wholesales']:
+            aggregated[icolumn]=aggregated[icolumn].astype(bool)
+
+        return aggregated.reindex(sorted(aggregated.columns), axis=1)
+
+    @staticmethod
+    def _aggregate_companies(data, aggregations):
+        """
+        ``groupby(level=0).agg`` with named aggregations (name -> (column,
+        aggregation)). The max of string columns is taken as the last value
+        after sorting, pandas would compute it group by group in python.
+        """
+        aggregated={}
+        for iname, (icolumn, iaggregation) in aggregations.items():
+            ivalues=data[icolumn]
+            if iaggregation=='max' and ivalues.dtype==object:
+                aggregated[iname]=ivalues.sort_values(kind='stable') \
+                    .groupby(level=0).last()
+            else:
+                aggregated[iname]=ivalues.groupby(level=0).agg(iaggregation)
+        return pd.DataFrame(aggregated)
+
     # %% Solar Data
     @staticmethod
     def load_solar_data(filepath: str):
         solar_wlw=pd.read_csv(filepath, index_col=0)
         solar_wlw.drop(["CO2_19_5", "STR_19_5"], axis=1, inplace=True)
 
-        DataMaster.apply_naming_convention(solar_wlw)
-        DataMaster.apply_error_placeholder(solar_wlw)
-        DataMaster.apply_correct_datatypes(solar_wlw)
+        DataMaster.clean_solar_data(solar_wlw)
         return solar_wlw
 
+    @staticmethod
+    def clean_solar_data(solar_wlw):
+        """
+        Naming convention, error placeholders and datatypes of the solar
+        data in one pass over each column.
+
+        Same result as ``apply_naming_convention``,
+        ``apply_error_placeholder`` and ``apply_correct_datatypes`` one
+        after the other, the placeholders are masked while the columns are
+        converted.
+        """
+        DataMaster.apply_naming_convention(solar_wlw)
+        solar_wlw["Anzahl Module"]=DataMaster._to_module_counts(
+            solar_wlw["Anzahl Module"]
+            )
+        solar_wlw["Leistung"]=DataMaster._to_power(solar_wlw["Leistung"])
+
     @staticmethod
     def apply_correct_datatypes(solar_wlw):
-        module=[]
-        leistung=[]
-        for iindex, idata in solar_wlw.iterrows():
-            try:
-                module.append(int(idata["Anzahl Module"].replace(".0", "")))
-            except AttributeError:
-                module.append(0)
-            leistung.append(float(idata["Leistung"]))
-        solar_wlw["Anzahl Module"]=module
-        solar_wlw["Leistung"]=leistung
+        solar_wlw["Anzahl Module"]=DataMaster._to_module_counts(
+            solar_wlw["Anzahl Module"]
+            )
+        solar_wlw["Leistung"]=DataMaster._to_power(solar_wlw["Leistung"])
+
+    @staticmethod
+    def _to_module_counts(modules: pd.Series) -> np.ndarray:
+        """
+        Number of modules as int64. Only strings hold a count (e.g. "12.0"),
+        error placeholders and any other value count as 0 modules.
+        """
+        module_counts=np.zeros(len(modules), dtype=np.int64)
+        if not is_string_dtype(modules.dtype):
+            return module_counts
+
+        is_count=(modules.map(type)==str) & \
+            ~modules.isin(SOLAR_ERROR_PLACEHOLDERS)
+        counts=pd.to_numeric(
+            modules[is_count].str.replace(".0", "", regex=False)
+            )
+        is_invalid=counts.isna() | (counts % 1!=0)
+        if is_invalid.any():
+            raise ValueError(f"Invalid module count "
+                             f"{modules[is_count][is_invalid].iloc[0]!r}")
+        module_counts[is_count.values]=counts.values
+        return module_counts
+
+    @staticmethod
+    def _to_power(power: pd.Series) -> np.ndarray:
+        """Installed power as float64, error placeholders are 0."""
+        power=power.mask(power.isin(SOLAR_ERROR_PLACEHOLDERS), 0)
+        return pd.to_numeric(power).to_numpy(dtype=np.float64)
 
     @staticmethod
     def apply_error_placeholder(solar_wlw):
         solar_data_map={
-            "no close roof found": 0,
-            "'NoneType' object has no attribute 'latitude'": 0,
-            "more than 1 roof object found": 0
+            iplaceholder: 0 for iplaceholder in SOLAR_ERROR_PLACEHOLDERS
             }
 
         # happens inplace so no need to return or reassign
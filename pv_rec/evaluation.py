@@ -0,0 +1,293 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from sklearn.model_selection import ShuffleSplit, StratifiedShuffleSplit
+
+from structlog import get_logger
+
+from pv_rec.recommender import Recommender
+
+
+log=get_logger()
+
+DEFAULT_THRESHOLDS=np.round(np.linspace(0, 1, 21), 2)
+METRICS=["recall", "miss_rate", "precision"]
+
+_worker_state=None
+
+
+def _init_evaluation_worker(mastr_data, wlw_data, settings, num_threads):
+    global _worker_state
+    # every worker gets the data once, the splits only send positions
+    from threadpoolctl import threadpool_limits
+
+    threadpool_limits(num_threads)
+    _worker_state=(mastr_data, wlw_data, settings)
+
+
+def _evaluate_split_in_worker(split):
+    mastr_data, wlw_data, settings=_worker_state
+    return evaluate_split(mastr_data, wlw_data, *split, **settings)
+
+
+def threshold_metrics(pv_affinity, is_positive, thresholds):
+    """
+    Recall, miss rate and precision for every threshold in one pass.
+
+    A company is recommended if its PV affinity is at least the threshold.
+    The affinities of both classes are sorted once, the number of
+    recommended companies per threshold is then a ``searchsorted``.
+
+    Parameters
+    ----------
+    pv_affinity : np.ndarray
+        PV affinity of every holdout company
+    is_positive : np.ndarray
+        True for companies that have a PV system (Mastr companies)
+    thresholds : array-like
+        Thresholds to evaluate
+
+    Returns
+    -------
+    pd.DataFrame
+        True and false positives, recall, miss rate and precision per
+        threshold. Precision is NaN where nothing is recommended.
+    """
+    pv_affinity=np.asarray(pv_affinity, dtype=np.float64)
+    is_positive=np.asarray(is_positive, dtype=bool)
+    thresholds=np.asarray(thresholds, dtype=np.float64)
+
+    positives=np.sort(pv_affinity[is_positive])
+    negatives=np.sort(pv_affinity[~is_positive])
+    true_positives=len(positives) - np.searchsorted(positives, thresholds)
+    false_positives=len(negatives) - np.searchsorted(negatives, thresholds)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        recall=true_positives / len(positives)
+        precision=true_positives / (true_positives + false_positives)
+    return pd.DataFrame({"true_positives": true_positives,
+                         "false_positives": false_positives,
+                         "recall": recall,
+                         "miss_rate": 1 - recall,
+                         "precision": precision
+                         },
+                        index=pd.Index(thresholds, name="threshold")
+                        )
+
+
+def make_splits(mastr_data, wlw_data, n_splits=10, test_size=100,
+                wlw_test_size=None, stratify=None, random_state=42):
+    """
+    Holdout positions of ``n_splits`` random or stratified splits.
+
+    Parameters
+    ----------
+    mastr_data, wlw_data : pd.DataFrame
+        Companies with and without PV system
+    n_splits : int
+        Number of splits
+    test_size : int or float
+        Mastr companies per holdout, as count or share
+    wlw_test_size : int or float, optional
+        WLW companies per holdout, defaults to ``test_size``. Use 0 to hold
+        out Mastr companies only, precision is NaN then.
+    stratify : str, optional
+        Column the holdouts are stratified on
+    random_state : int
+        Seed of the splits
+
+    Returns
+    -------
+    list
+        (Mastr positions, WLW positions) of the holdout companies per split
+    """
+    if wlw_test_size is None:
+        wlw_test_size=test_size
+
+    mastr_holdouts=_holdout_positions(mastr_data, n_splits, test_size,
+                                      stratify, random_state
+                                      )
+    if wlw_test_size:
+        wlw_holdouts=_holdout_positions(wlw_data, n_splits, wlw_test_size,
+                                        stratify, random_state + 1
+                                        )
+    else:
+        wlw_holdouts=[np.array([], dtype=np.int64)] * n_splits
+    return list(zip(mastr_holdouts, wlw_holdouts))
+
+
+def _holdout_positions(data, n_splits, test_size, stratify, random_state):
+    if stratify is None:
+        splitter=ShuffleSplit(n_splits=n_splits, test_size=test_size,
+                              random_state=random_state
+                              )
+        return [itest for _, itest in splitter.split(data)]
+
+    splitter=StratifiedShuffleSplit(n_splits=n_splits, test_size=test_size,
+                                    random_state=random_state
+                                    )
+    strata=data[stratify].astype(str).values
+    return [itest for _, itest in splitter.split(data, strata)]
+
+
+def evaluate_split(mastr_data, wlw_data, mastr_holdout, wlw_holdout,
+                   thresholds=DEFAULT_THRESHOLDS, cut_line=1.5,
+                   mapping_needed=True, fit_kwargs=None):
+    """
+    Fit a ``Recommender`` without the holdout companies and score them.
+
+    Returns the ``threshold_metrics`` of the holdout.
+    """
+    is_mastr_holdout=np.zeros(len(mastr_data), dtype=bool)
+    is_mastr_holdout[mastr_holdout]=True
+    is_wlw_holdout=np.zeros(len(wlw_data), dtype=bool)
+    is_wlw_holdout[wlw_holdout]=True
+
+    recommender=Recommender()
+    recommender.cut_line=cut_line
+    recommender.fit(wlw_data=wlw_data[~is_wlw_holdout].copy(),
+                    mastr_data=mastr_data[~is_mastr_holdout].copy(),
+                    mapping_needed=mapping_needed,
+                    **(fit_kwargs or {})
+                    )
+
+    holdout=pd.concat([mastr_data[is_mastr_holdout],
+                       wlw_data[is_wlw_holdout]
+                       ])
+    pv_affinity, _=recommender.recommend(holdout,
+                                         mapping_needed=mapping_needed
+                                         )
+    is_positive=np.arange(len(holdout)) < is_mastr_holdout.sum()
+    return threshold_metrics(pv_affinity.pv_affinity.values, is_positive,
+                             thresholds
+                             )
+
+
+def aggregate_metrics(split_metrics, confidence=0.95):
+    """
+    Mean and confidence interval (t-distribution over the splits) of every
+    metric per threshold.
+
+    Parameters
+    ----------
+    split_metrics : pd.DataFrame
+        ``threshold_metrics`` of all splits, stacked
+    confidence : float
+        Confidence level of the intervals
+
+    Returns
+    -------
+    pd.DataFrame
+        Columns (metric, mean | ci_low | ci_high) per threshold
+    """
+    grouped=split_metrics.groupby(level="threshold")[METRICS]
+    means=grouped.mean()
+    counts=grouped.count()
+    half_widths=stats.t.ppf((1 + confidence) / 2, counts - 1) \
+        * grouped.std() / np.sqrt(counts)
+    return pd.concat({"mean": means,
+                      "ci_low": means - half_widths,
+                      "ci_high": means + half_widths
+                      },
+                     axis=1
+                     ).swaplevel(axis=1)[METRICS]
+
+
+def evaluate_recommender(mastr_data, wlw_data, n_splits=10, test_size=100,
+                         wlw_test_size=None, stratify=None,
+                         thresholds=DEFAULT_THRESHOLDS, cut_line=1.5,
+                         mapping_needed=True, fit_kwargs=None,
+                         confidence=0.95, n_jobs=-1, random_state=42):
+    """
+    Evaluate the ``Recommender`` on repeated holdout splits.
+
+    Every split fits a recommender without its holdout companies and
+    computes recall, miss rate and precision of the holdout for the whole
+    threshold grid. The splits run in a pool of worker processes, the
+    company data is sent to every worker once.
+
+    The companies are expected to be labeled already
+    (``ProductShelf.append_to_df``), the embeddings and shelf labels are
+    reused by all splits. The ``product_categories`` column is dropped
+    before the data is sent to the workers.
+
+    Parameters
+    ----------
+    mastr_data, wlw_data : pd.DataFrame
+        Labeled companies with and without PV system, like the data passed
+        to ``Recommender.fit``
+    n_splits : int
+        Number of holdout splits
+    test_size, wlw_test_size, stratify :
+        See ``make_splits``
+    thresholds : array-like
+        PV affinity thresholds to evaluate
+    cut_line : float
+        Cut line of the recommenders
+    mapping_needed : bool
+        Map the ordinal columns
+    fit_kwargs : dict, optional
+        Further arguments of ``Recommender.fit``
+    confidence : float
+        Confidence level of the intervals
+    n_jobs : int
+        Number of worker processes, negative values count back from the
+        number of cores (-1 uses all cores), 1 runs in this process
+    random_state : int
+        Seed of the splits
+
+    Returns
+    -------
+    summary : pd.DataFrame
+        Mean and confidence interval of every metric per threshold
+    split_metrics : pd.DataFrame
+        Metrics of every split and threshold
+    """
+    start_time=time.time()
+    splits=make_splits(mastr_data, wlw_data,
+                       n_splits=n_splits,
+                       test_size=test_size,
+                       wlw_test_size=wlw_test_size,
+                       stratify=stratify,
+                       random_state=random_state
+                       )
+    mastr_data=mastr_data.drop(columns="product_categories",
+                               errors="ignore"
+                               )
+    wlw_data=wlw_data.drop(columns="product_categories", errors="ignore")
+    settings={"thresholds": thresholds,
+              "cut_line": cut_line,
+              "mapping_needed": mapping_needed,
+              "fit_kwargs": fit_kwargs
+              }
+
+    num_cores=os.cpu_count() or 1
+    if n_jobs < 0:
+        n_jobs=max(num_cores + 1 + n_jobs, 1)
+    n_jobs=min(n_jobs, len(splits))
+
+    log.info("Evaluating splits", n_splits=len(splits), n_jobs=n_jobs)
+    if n_jobs==1:
+        results=[evaluate_split(mastr_data, wlw_data, *isplit, **settings)
+                 for isplit in splits]
+    else:
+        with ProcessPoolExecutor(
+                max_workers=n_jobs,
+                mp_context=get_context("spawn"),
+                initializer=_init_evaluation_worker,
+                initargs=(mastr_data, wlw_data, settings,
+                          max(num_cores // n_jobs, 1)
+                          )
+                ) as pool:
+            results=list(pool.map(_evaluate_split_in_worker, splits))
+
+    split_metrics=pd.concat(results, keys=range(len(results)),
+                            names=["split"]
+                            )
+    log.info("Splits evaluated", duration=time.time() - start_time)
+    return aggregate_metrics(split_metrics, confidence), split_metrics
@@ -1,19 +1,41 @@
+import hashlib
+import json
 import os
+import time
+import unicodedata
 from abc import ABC
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
 from shutil import ExecError
 
 import dotenv
 import numpy as np
 import pandas as pd
 import requests
-from sentence_transformers import SentenceTransformer
 from sklearn.cluster import KMeans
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import HashingVectorizer, \
+    TfidfTransformer
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import RobustScaler
-import torch
+from structlog import get_logger
+
+from pv_rec.categories import ProductCategoriesArray, unique_categories
+
+# torch and sentence_transformers are imported where the model is used, so
+# that processes which only look up embeddings or shelf labels start fast
 
 dotenv.load_dotenv(dotenv.find_dotenv())
 
+log=get_logger()
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl=None
+
 
 class _HuggingFaceConnection(ABC):
     def __init__(self):
@@ -24,33 +46,506 @@ class _HuggingFaceConnection(ABC):
         self.llm_endpoint=None
 
 
+# every worker of the process pool in embedd_it_parallel holds its own model
+_worker_model=None
+
+
+def _init_embedding_worker(model_name, num_threads, quantize_model=False,
+                           max_seq_length=None):
+    global _worker_model
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    # cap the intra-op threads, otherwise every worker spawns as many threads
+    # as there are cores and the workers fight for them
+    torch.set_num_threads(num_threads)
+    _worker_model=SentenceTransformer(model_name, device="cpu")
+    # same settings as AbstractProductEncoder._load_model, the embeddings of
+    # both paths end up in the same cache
+    if max_seq_length is not None:
+        _worker_model.max_seq_length=max_seq_length
+    if quantize_model:
+        _worker_model=_quantize_model(_worker_model)
+
+
+def _quantize_model(model):
+    import torch
+
+    # int8 dynamic quantization of the linear layers, CPU inference only
+    return torch.quantization.quantize_dynamic(model,
+                                               {torch.nn.Linear},
+                                               dtype=torch.qint8
+                                               )
+
+
+def _embedd_chunk(texts, batch_size=32):
+    import torch
+
+    with torch.no_grad():
+        embeddings=_worker_model.encode(texts,
+                                        batch_size=batch_size,
+                                        show_progress_bar=False
+                                        )
+    return pd.DataFrame(embeddings)
+
+
+class QuantizedEmbeddings:
+    """
+    Int8 embeddings with one symmetric scale per dimension.
+
+    Stores the embeddings at a quarter of the float32 memory, rows are only
+    converted back to float32 when they are requested.
+
+    Parameters
+    ----------
+    codes : np.ndarray
+        int8 matrix of shape (n_texts, n_dims)
+    scales : np.ndarray
+        float32 scale for every dimension
+    index : list
+        Texts of the rows
+    """
+    dtypes=("float32", "float16", "int8")
+
+    def __init__(self, codes, scales, index):
+        self.codes=codes
+        self.scales=scales
+        self.index=pd.Index(index)
+
+    @classmethod
+    def from_embeddings(cls, embeddings, index):
+        embeddings=np.asarray(embeddings, dtype=np.float32)
+        scales=np.abs(embeddings).max(axis=0) / 127
+        scales[scales==0]=1
+        codes=np.clip(np.rint(embeddings / scales), -127, 127) \
+            .astype(np.int8)
+        return cls(codes, scales.astype(np.float32), index)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def lookup(self, texts):
+        """Dequantized embeddings of ``texts`` as a DataFrame."""
+        rows=self._get_rows(texts)
+        if (rows < 0).any():
+            raise KeyError(
+                f"{list(np.asarray(texts)[rows < 0])} not in embeddings"
+                )
+        return pd.DataFrame(self.codes[rows] * self.scales, index=texts)
+
+    def _get_rows(self, texts):
+        if self.index.is_unique:
+            return self.index.get_indexer(texts)
+        # duplicated texts are looked up at their first occurrence
+        is_first=~self.index.duplicated()
+        first_rows=np.flatnonzero(is_first)
+        rows=self.index[is_first].get_indexer(texts)
+        return np.where(rows < 0, -1, first_rows[rows])
+
+    def to_frame(self):
+        return pd.DataFrame(self.codes * self.scales, index=self.index)
+
+
+class EmbeddingCache:
+    """
+    Content addressed on-disk cache for text embeddings.
+
+    Every model (and setting of the model that changes its embeddings) gets
+    its own directory below ``cache_dir``. The vectors are
+    appended to a raw float32 file that is read back as a memory map, the
+    ``index.json`` maps the hash of (model_name, normalized text) to the row
+    of the vector. Appends are locked (on POSIX systems), processes can
+    share a cache.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Root directory of the cache
+    model_name : str
+        Name of the model that produced the embeddings
+    settings : dict, optional
+        Settings of the model that change the embeddings, e.g.
+        ``max_seq_length``
+    """
+    vector_file="vectors.f32"
+    index_file="index.json"
+
+    def __init__(self, cache_dir, model_name, settings=None):
+        self.model_name=model_name
+        self.settings=settings or {}
+        model_id=model_name
+        if self.settings:
+            model_id+="\n" + json.dumps(self.settings, sort_keys=True)
+        self.cache_dir=os.path.join(
+            cache_dir,
+            hashlib.sha1(model_id.encode("utf-8")).hexdigest()
+            )
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.dim=None
+        self.index={}
+        self._vectors=None
+        self._load_index()
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(unicodedata.normalize("NFC", str(text)).split())
+
+    def key(self, text):
+        return hashlib.sha1(
+            f"{self.model_name}\n{self.normalize(text)}".encode("utf-8")
+            ).hexdigest()
+
+    def missing(self, texts):
+        """Unique texts of ``texts`` that are not in the cache yet."""
+        missing_texts={}
+        for itext in texts:
+            ikey=self.key(itext)
+            if ikey not in self.index and ikey not in missing_texts:
+                missing_texts[ikey]=itext
+        return list(missing_texts.values())
+
+    def get(self, texts):
+        if len(texts)==0:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        rows=[self.index[self.key(itext)] for itext in texts]
+        return np.asarray(self.vectors[rows])
+
+    def add(self, texts, vectors):
+        vectors=np.ascontiguousarray(vectors, dtype=np.float32)
+        if len(texts)==0:
+            return
+        if self.dim is None:
+            self.dim=vectors.shape[1]
+        elif vectors.shape[1]!=self.dim:
+            raise ValueError(
+                f"Embedding dimension {vectors.shape[1]} does not match the "
+                f"cached dimension {self.dim}"
+                )
+
+        with open(self._path(self.vector_file), "ab") as file:
+            # other processes append to the same files, the lock is held
+            # until the index points to the new rows
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            # rows are numbered from the file, not from the index. Rows of
+            # interrupted runs stay unused instead of shifting the offsets,
+            # a partially written row is cut off
+            num_rows=self._num_file_rows()
+            file.truncate(num_rows * self._row_bytes())
+            file.write(vectors.tobytes())
+            file.flush()
+
+            self._load_index()
+            for irow, itext in enumerate(texts, start=num_rows):
+                self.index[self.key(itext)]=irow
+            self._dump_index()
+        self._vectors=None
+
+    @property
+    def vectors(self):
+        if self._vectors is None:
+            self._vectors=np.memmap(self._path(self.vector_file),
+                                    dtype=np.float32,
+                                    mode="r",
+                                    shape=(self._num_file_rows(), self.dim)
+                                    )
+        return self._vectors
+
+    def _row_bytes(self):
+        return self.dim * np.dtype(np.float32).itemsize
+
+    def _num_file_rows(self):
+        if not os.path.exists(self._path(self.vector_file)):
+            return 0
+        return os.path.getsize(self._path(self.vector_file)) \
+            // self._row_bytes()
+
+    def _path(self, filename):
+        return os.path.join(self.cache_dir, filename)
+
+    def _load_index(self):
+        if not os.path.exists(self._path(self.index_file)):
+            return
+        with open(self._path(self.index_file), encoding="utf-8") as file:
+            meta=json.load(file)
+        self.dim=meta["dim"]
+
+        # rows behind the end of the vector file were never written
+        num_rows=self._num_file_rows()
+        self.index={ikey: irow for ikey, irow in meta["index"].items() if
+                    irow < num_rows}
+        if len(self.index) < len(meta["index"]):
+            log.warning("Dropping embedding cache entries without vectors",
+                        dropped=len(meta["index"]) - len(self.index)
+                        )
+
+    def _dump_index(self):
+        # write to a temporary file first, an interrupted run must not leave
+        # an index that points to rows which were never written
+        tmp_path=self._path(self.index_file + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump({"model_name": self.model_name,
+                       "settings": self.settings,
+                       "dim": self.dim,
+                       "index": self.index},
+                      file
+                      )
+        os.replace(tmp_path, self._path(self.index_file))
+
+
 class AbstractProductEncoder(_HuggingFaceConnection):
     def __init__(
         self,
         products,
-        model_name
+        model_name,
+        cache_dir=None,
+        batch_size=32,
+        max_seq_length=None,
+        length_bucketing=False,
+        embedding_dtype="float32",
+        quantize_model=False
         ):
         super().__init__()
+        if embedding_dtype not in QuantizedEmbeddings.dtypes:
+            raise ValueError(
+                f"embedding_dtype must be one of {QuantizedEmbeddings.dtypes}"
+                f", got {embedding_dtype}"
+                )
 
         self.model = None
         self.products=products
         self.model_name=model_name
 
+        self.batch_size=batch_size
+        self.max_seq_length=max_seq_length
+        self.length_bucketing=length_bucketing
+        self.embedding_dtype=embedding_dtype
+        self.quantize_model=quantize_model
+
+        self.cache=None
+        if cache_dir is not None:
+            self.cache=EmbeddingCache(cache_dir, model_name,
+                                      settings=self._model_settings()
+                                      )
+
+    def _model_settings(self):
+        # settings that change the embeddings, the defaults are left out so
+        # that caches written with them stay valid
+        settings={"max_seq_length": self.max_seq_length,
+                  "quantize_model": self.quantize_model}
+        return {isetting: ivalue for isetting, ivalue in settings.items() if
+                ivalue is not None and ivalue is not False}
+
     def embedd_it_local(self, texts):
         print("embedding texts")
+        if self.cache is None:
+            embeddings=self._encode(texts)
+        else:
+            missing_texts=self.cache.missing(texts)
+            log.info("Embedding cache lookup",
+                     hits=len(texts) - len(missing_texts),
+                     misses=len(missing_texts)
+                     )
+            if missing_texts:
+                self.cache.add(missing_texts, self._encode(missing_texts))
+            embeddings=self.cache.get(texts)
+
+        return self._to_output(embeddings, texts)
+
+    def embedd_it_parallel(self, n_jobs=-1, n_chunks=4):
+        """
+        Embed the unique products with a pool of worker processes.
+
+        The products are sharded into ``n_chunks`` chunks, every worker loads
+        the model once and encodes the chunks it gets assigned. The torch
+        threads of each worker are capped to ``cpu_count // n_jobs``.
+
+        Parameters
+        ----------
+        n_jobs : int
+            Number of worker processes, negative values count back from the
+            number of cores like in joblib (-1 uses all cores)
+        n_chunks : int
+            Number of chunks the products are split into, use more chunks
+            than workers to balance the load
+
+        Returns
+        -------
+        pd.DataFrame
+            Embeddings with the products as index, same layout as the
+            result of ``embedd_it_local``
+        """
+        if n_jobs==0:
+            raise ValueError("n_jobs must not be 0, use None or 1 to embed "
+                             "in one worker process")
+        texts=list(dict.fromkeys(self.products))
+        if self.cache is not None:
+            missing_texts=self.cache.missing(texts)
+            if missing_texts:
+                embeddings=self._embedd_chunks_parallel(missing_texts,
+                                                        n_jobs=n_jobs,
+                                                        n_chunks=n_chunks
+                                                        )
+                self.cache.add(missing_texts, embeddings.values)
+            return self._to_output(self.cache.get(texts), texts)
+
+        embeddings=self._embedd_chunks_parallel(texts,
+                                                n_jobs=n_jobs,
+                                                n_chunks=n_chunks
+                                                )
+        return self._to_output(embeddings.values, texts)
+
+    def _to_output(self, embeddings, texts):
+        # the cache always holds float32, the precision is only reduced for
+        # the returned embeddings
+        if self.embedding_dtype=="int8":
+            return QuantizedEmbeddings.from_embeddings(embeddings, texts)
+
+        embeddings_df = pd.DataFrame(
+            np.asarray(embeddings, dtype=self.embedding_dtype),
+            index=texts,
+        )
+        return embeddings_df
+
+    def _embedd_chunks_parallel(self, texts, n_jobs, n_chunks):
+        num_cores=os.cpu_count() or 1
+        if n_jobs is None:
+            n_jobs=1
+        elif n_jobs < 0:
+            n_jobs=max(num_cores + 1 + n_jobs, 1)
+
+        chunks=[list(ichunk) for ichunk in
+                np.array_split(np.asarray(texts, dtype=object),
+                               max(min(n_chunks, len(texts)), 1)
+                               )]
+        n_jobs=min(n_jobs, len(chunks))
+        num_threads=max(num_cores // n_jobs, 1)
+
+        log.info("Embedding in parallel",
+                 n_texts=len(texts),
+                 n_jobs=n_jobs,
+                 n_chunks=len(chunks),
+                 threads_per_job=num_threads
+                 )
+        # spawn instead of fork, a forked torch runtime can deadlock
+        with ProcessPoolExecutor(
+                max_workers=n_jobs,
+                mp_context=get_context("spawn"),
+                initializer=_init_embedding_worker,
+                initargs=(self.model_name, num_threads, self.quantize_model,
+                          self.max_seq_length)
+                ) as pool:
+            results=list(pool.map(partial(_embedd_chunk,
+                                          batch_size=self.batch_size
+                                          ),
+                                  chunks
+                                  ))
+
+        return self._post_process_results(results, texts)
+
+    @staticmethod
+    def _join_results(results):
+        return pd.concat([pd.DataFrame(iresult) for iresult in results],
+                         axis=0
+                         )
+
+    def _post_process_results(self, results, texts=None):
+        if texts is None:
+            texts=self.products
+        embeddings=self._join_results(results)
+        embeddings.index=texts
+        return embeddings
+
+    def _load_model(self):
         if self.model is None:
+            from sentence_transformers import SentenceTransformer
+
             self.model = SentenceTransformer(self.model_name)
+            if self.max_seq_length is not None:
+                self.model.max_seq_length=self.max_seq_length
+            if self.quantize_model:
+                self.model=_quantize_model(self.model)
+        return self.model
+
+    def _encode(self, texts):
+        if self.length_bucketing:
+            return self._encode_bucketed(texts)
+
+        import torch
 
+        model=self._load_model()
         with torch.no_grad():
-            embeddings = self.model.encode(
+            embeddings = model.encode(
                 texts,
+                batch_size=self.batch_size,
                 show_progress_bar=True
             )
-        embeddings_df = pd.DataFrame(
-            embeddings,
-            index=texts,
-        )
-        return embeddings_df
+        return embeddings
+
+    def _encode_bucketed(self, texts):
+        """
+        Encode texts in batches of similar token length.
+
+        The texts are sorted by their token length, so that each batch is
+        padded to a similar length, and the embeddings are written back in
+        the original order. Throughput and padding efficiency are logged to
+        tune ``batch_size`` and ``max_seq_length``.
+        """
+        import torch
+
+        texts=list(texts)
+        model=self._load_model()
+        if not texts:
+            return np.empty((0, model.get_sentence_embedding_dimension()),
+                            dtype=np.float32
+                            )
+
+        token_lengths=np.array([
+            len(iids) for iids in model.tokenizer(
+                texts,
+                truncation=True,
+                max_length=model.max_seq_length
+                )["input_ids"]
+            ])
+        sorted_idx=np.argsort(token_lengths, kind="stable")
+
+        embeddings=None
+        padded_tokens=0
+        start_time=time.time()
+        with torch.no_grad():
+            for ibatch_start in range(0, len(texts), self.batch_size):
+                ibatch_idx=sorted_idx[ibatch_start:
+                                      ibatch_start + self.batch_size]
+                ibatch_embeddings=model.encode(
+                    [texts[iidx] for iidx in ibatch_idx],
+                    batch_size=len(ibatch_idx),
+                    show_progress_bar=False
+                    )
+                if embeddings is None:
+                    embeddings=np.empty(
+                        (len(texts), ibatch_embeddings.shape[1]),
+                        dtype=ibatch_embeddings.dtype
+                        )
+                embeddings[ibatch_idx]=ibatch_embeddings
+                padded_tokens+= \
+                    len(ibatch_idx) * token_lengths[ibatch_idx].max()
+        duration=time.time() - start_time
+
+        log.info("Bucketed embedding done",
+                 duration=duration,
+                 batch_size=self.batch_size,
+                 max_seq_length=model.max_seq_length,
+                 tokens_per_second=float(token_lengths.sum()
+                                         / max(duration, 1e-9)),
+                 padding_efficiency=float(token_lengths.sum() / padded_tokens)
+                 )
+        return embeddings
 
 
 class WlwProductEncoder(AbstractProductEncoder):
@@ -58,21 +553,129 @@ class WlwProductEncoder(AbstractProductEncoder):
         self,
         products,
         model_name="Snowflake/snowflake-arctic-embed-l-v2.0",
-        needs_preprocessing=True
+        needs_preprocessing=True,
+        **kwargs
         ):
         super().__init__(
             products=products,
-            model_name=model_name
+            model_name=model_name,
+            **kwargs
             )
+        # fitted embedding table, rows are only ever appended so that the
+        # DataFrame returned by ``embeddings`` is a view on the buffer
+        self._table_buffer=None
+        self._table_rows={}
+        self._table_index=pd.Index([])
+        self._table_view=None
+
         if needs_preprocessing:
             self._pre_process_data()
 
+    @property
+    def embeddings(self):
+        """All products embedded so far, indexed by the product."""
+        if self._table_view is None and self._table_buffer is not None:
+            self._table_view=pd.DataFrame(
+                self._table_buffer[:len(self._table_rows)],
+                index=self._table_index,
+                copy=False
+                )
+        return self._table_view
+
+    def embedd_it_local(self, texts):
+        embeddings=super().embedd_it_local(texts)
+        if self._is_dense_frame(embeddings):
+            self._append_to_table(embeddings)
+        return embeddings
+
+    def embedd_it_parallel(self, n_jobs=-1, n_chunks=4):
+        embeddings=super().embedd_it_parallel(n_jobs=n_jobs,
+                                              n_chunks=n_chunks
+                                              )
+        if self._is_dense_frame(embeddings):
+            self._append_to_table(embeddings)
+        return embeddings
+
+    @staticmethod
+    def _is_dense_frame(embeddings):
+        return isinstance(embeddings, pd.DataFrame) and \
+            not any(isinstance(idtype, pd.SparseDtype) for idtype in
+                    embeddings.dtypes)
+
+    def embed_new(self, products):
+        """
+        Embed only the products that are not in the embedding table yet.
+
+        Parameters
+        ----------
+        products : pd.Series or list
+            Either the product categories of companies (a Series of sets) or
+            a list of products
+
+        Returns
+        -------
+        pd.DataFrame
+            View on the embedding table with the previously embedded and the
+            new products
+        """
+        if self.embedding_dtype=="int8":
+            raise ValueError("The embedding table does not support int8 "
+                             "embeddings, use float32 or float16"
+                             )
+        if isinstance(products, pd.Series):
+            products=unique_categories(products)
+        new_products=[iproduct for iproduct in dict.fromkeys(products) if
+                      isinstance(iproduct, str) and
+                      iproduct not in self._table_rows]
+
+        log.info("Embedding new products",
+                 new_products=len(new_products),
+                 known_products=len(self._table_rows)
+                 )
+        if new_products:
+            self.embedd_it_local(new_products)
+        return self.embeddings
+
+    def _append_to_table(self, embeddings):
+        is_new=[iproduct not in self._table_rows for iproduct in
+                embeddings.index]
+        embeddings=embeddings[is_new & ~embeddings.index.duplicated()]
+        if embeddings.empty:
+            return
+
+        num_rows=len(self._table_rows)
+        num_new_rows=len(embeddings.index)
+        if self._table_buffer is None:
+            # reserve as much headroom as the fitted products, the first
+            # embed_new calls then write into the buffer without a copy
+            self._table_buffer=np.empty(
+                (2 * num_new_rows, embeddings.shape[1]),
+                dtype=embeddings.values.dtype
+                )
+        elif num_rows + num_new_rows > len(self._table_buffer):
+            # grow geometrically, the existing rows are only copied when the
+            # capacity is exceeded
+            capacity=max(2 * len(self._table_buffer),
+                         num_rows + num_new_rows
+                         )
+            buffer=np.empty((capacity, self._table_buffer.shape[1]),
+                            dtype=self._table_buffer.dtype
+                            )
+            buffer[:num_rows]=self._table_buffer[:num_rows]
+            self._table_buffer=buffer
+
+        self._table_buffer[num_rows:num_rows + num_new_rows]=embeddings.values
+        for irow, iproduct in enumerate(embeddings.index, start=num_rows):
+            self._table_rows[iproduct]=irow
+        self._table_index=self._table_index.append(embeddings.index)
+        self._table_view=None
+
     def _pre_process_data(self):
         self._make_products_unique()
         self._filter_data_for_strings()
 
     def _make_products_unique(self):
-        self.products=list(self.products.explode().unique())
+        self.products=unique_categories(self.products)
 
     def _filter_data_for_strings(self):
         self.products=[iproduct_cat for iproduct_cat in
@@ -80,7 +683,200 @@ class WlwProductEncoder(AbstractProductEncoder):
                        not isinstance(iproduct_cat, float)]
 
 
+class CategoryBagEncoder(WlwProductEncoder):
+    """
+    Transformer free encoder based on the character n-grams of the products.
+
+    The n-grams of every product are hashed into a sparse count matrix and
+    weighted with TF-IDF, optionally reduced to dense vectors with
+    TruncatedSVD. IDF weights and SVD are fitted on the first call of
+    ``embedd_it_local``, later calls reuse them. The result is indexed by
+    the product like the SentenceTransformer embeddings, so it can be used
+    for ``ProductShelf.fit`` and ``ProductShelf.append_to_df`` as well.
+
+    Parameters
+    ----------
+    products : pd.Series or list
+        Product categories of the companies
+    n_features : int
+        Number of hash buckets
+    n_components : int, optional
+        Dimensions of the SVD, None keeps the sparse TF-IDF matrix (pandas
+        handles every hash bucket as a sparse column, keep ``n_features``
+        small in this case)
+    ngram_range : tuple
+        Range of the character n-grams
+    embedding_dtype : str
+        dtype of the embeddings, int8 needs ``n_components`` since the
+        TF-IDF weights would be truncated to 0
+    """
+    def __init__(
+        self,
+        products,
+        n_features=2**14,
+        n_components=128,
+        ngram_range=(3, 5),
+        needs_preprocessing=True,
+        embedding_dtype="float32",
+        random_state=None
+        ):
+        if n_components is None and embedding_dtype=="int8":
+            raise ValueError("int8 embeddings need n_components, the sparse "
+                             "TF-IDF features can not be quantized"
+                             )
+        super().__init__(
+            products=products,
+            model_name="category-bag",
+            needs_preprocessing=needs_preprocessing,
+            embedding_dtype=embedding_dtype
+            )
+        self.vectorizer=HashingVectorizer(analyzer="char_wb",
+                                          ngram_range=ngram_range,
+                                          n_features=n_features,
+                                          alternate_sign=False,
+                                          norm=None
+                                          )
+        self.tfidf=TfidfTransformer(sublinear_tf=True)
+        self.n_components=n_components
+        self.svd=None
+        if n_components is not None:
+            self.svd=TruncatedSVD(n_components=n_components,
+                                  random_state=random_state
+                                  )
+        self.is_fitted=False
+
+    def embedd_it_parallel(self, n_jobs=-1, n_chunks=4):
+        """
+        Encode the unique products in this process, ``n_jobs`` and
+        ``n_chunks`` are ignored. There is no model to load in the workers
+        and the fitted IDF weights and SVD have to stay in this encoder.
+        """
+        return self.embedd_it_local(list(dict.fromkeys(self.products)))
+
+    def _encode(self, texts):
+        counts=self.vectorizer.transform(texts)
+        if not self.is_fitted:
+            self.tfidf.fit(counts)
+            if self.svd is not None:
+                # fewer samples than components limit the SVD, the
+                # requested n_components is kept for later fits
+                self.svd.set_params(n_components=max(
+                    min(self.n_components, counts.shape[0] - 1), 1
+                    ))
+                self.svd.fit(self.tfidf.transform(counts))
+            self.is_fitted=True
+
+        features=self.tfidf.transform(counts)
+        if self.svd is None:
+            return features
+        return self.svd.transform(features)
+
+    def _to_output(self, embeddings, texts):
+        if self.svd is not None:
+            return super()._to_output(embeddings, texts)
+        return pd.DataFrame.sparse.from_spmatrix(
+            embeddings.astype(self.embedding_dtype),
+            index=texts
+            )
+
+
+class StaticVocabularyEncoder(AbstractProductEncoder):
+    """
+    Encoder that looks up precomputed category embeddings.
+
+    The vocabulary file maps every known category to its vector, no
+    transformer is loaded as long as all products are known. Unknown
+    products are either skipped, embedded with the live model or raise a
+    KeyError, depending on ``on_unknown``. Skipped products have no
+    embedding, label companies with
+    ``ProductShelf.append_to_df(..., skip_unknown=True)`` in this case.
+
+    Parameters
+    ----------
+    products : list
+        Products to embed
+    vocabulary_filepath : str
+        npz file written by ``save_vocabulary``
+    on_unknown : str
+        "skip", "model" or "raise"
+    """
+    on_unknown_options=("skip", "model", "raise")
+
+    def __init__(
+        self,
+        products,
+        vocabulary_filepath,
+        on_unknown="skip",
+        **kwargs
+        ):
+        if on_unknown not in self.on_unknown_options:
+            raise ValueError(
+                f"on_unknown must be one of {self.on_unknown_options}, "
+                f"got {on_unknown}"
+                )
+        with np.load(vocabulary_filepath) as vocabulary:
+            vocabulary_products=vocabulary["products"].tolist()
+            vectors=vocabulary["vectors"]
+            kwargs.setdefault("model_name", str(vocabulary["model_name"]))
+
+        super().__init__(products=products, **kwargs)
+        self.on_unknown=on_unknown
+        self.vocabulary=dict(zip(vocabulary_products,
+                                 range(len(vocabulary_products))
+                                 ))
+        self.vectors=vectors
+
+    @staticmethod
+    def save_vocabulary(filepath, embeddings, model_name, dtype="float32"):
+        """
+        Write embeddings (DataFrame indexed by the product) as a static
+        vocabulary, float16 halves the file size.
+        """
+        embeddings=embeddings[~embeddings.index.duplicated()]
+        np.savez(filepath,
+                 products=np.array(embeddings.index, dtype=str),
+                 vectors=embeddings.values.astype(dtype),
+                 model_name=np.array(model_name)
+                 )
+
+    def embedd_it_local(self, texts):
+        texts=list(texts)
+        unknown_texts=[itext for itext in dict.fromkeys(texts) if
+                       itext not in self.vocabulary]
+        if unknown_texts:
+            log.info("Products missing in the static vocabulary",
+                     unknown=len(unknown_texts),
+                     on_unknown=self.on_unknown
+                     )
+            if self.on_unknown=="raise":
+                raise KeyError(
+                    f"{len(unknown_texts)} products are not in the static "
+                    f"vocabulary, e.g. {unknown_texts[:3]}"
+                    )
+            elif self.on_unknown=="skip":
+                unknown=set(unknown_texts)
+                texts=[itext for itext in texts if itext not in unknown]
+            else:
+                self._add_to_vocabulary(unknown_texts,
+                                        self._encode(unknown_texts)
+                                        )
+
+        rows=[self.vocabulary[itext] for itext in texts]
+        return self._to_output(self.vectors[rows], texts)
+
+    def _add_to_vocabulary(self, texts, vectors):
+        num_rows=len(self.vectors)
+        self.vectors=np.concatenate(
+            [self.vectors, np.asarray(vectors, dtype=self.vectors.dtype)]
+            )
+        for irow, itext in enumerate(texts, start=num_rows):
+            self.vocabulary[itext]=irow
+
+
 class ProductShelf:
+    # label of products without shelf in get_product_labels
+    unknown_label=-1
+
     def __init__(
         self,
         clustering=None,
@@ -95,8 +891,13 @@ class ProductShelf:
         self.pipeline=self._set_pipeline()
 
         self.product_shelves=None
+        # product -> shelf label, filled by fit, a product never changes its
+        # shelf afterwards
+        self.product_labels={}
 
     def cluster_products(self, embeddings):
+        if isinstance(embeddings, QuantizedEmbeddings):
+            embeddings=embeddings.to_frame()
         self.product_shelves= \
             self.pipeline.predict(embeddings)
 
@@ -110,35 +911,289 @@ class ProductShelf:
             )
 
     def fit(self, embeddings):
+        if isinstance(embeddings, QuantizedEmbeddings):
+            embeddings=embeddings.to_frame()
         self.pipeline.fit(embeddings)
 
-    def append_to_df(self, data, embeddings):
+        self.product_labels={}
+        self._add_product_labels(embeddings.index,
+                                 self.pipeline.predict(embeddings)
+                                 )
+
+    def fit_streaming(self, embedding_chunks, chunk_size=10000,
+                      sample_size=100000, random_state=None):
+        """
+        Fit the shelf chunk by chunk with bounded memory.
+
+        The scaler is fitted with ``partial_fit`` if it supports it, otherwise
+        (e.g. the default ``RobustScaler``) on a reservoir sample of at most
+        ``sample_size`` rows. The clustering has to support ``partial_fit``,
+        e.g. ``MiniBatchKMeans``. The rows should be in random order, the
+        clusters are initialized from the first chunk.
+
+        Parameters
+        ----------
+        embedding_chunks : callable, iterable, np.ndarray or pd.DataFrame
+            Either a function that returns a new iterable of chunks
+            (DataFrames or arrays) every time it is called, a collection of
+            chunks like a list of DataFrames, or an array, memory map or
+            DataFrame that is read in chunks of ``chunk_size``. The chunks
+            are read three times, so a generator can not be passed
+            directly, pass the function that creates it instead
+        chunk_size : int
+            Number of rows per chunk if ``embedding_chunks`` is an array
+        sample_size : int
+            Maximum number of rows kept to fit scalers without partial_fit
+        random_state : int, optional
+            Seed of the reservoir sampling
+        """
+        if not hasattr(self.clustering, "partial_fit"):
+            raise ValueError(
+                f"{type(self.clustering).__name__} does not support "
+                f"partial_fit, use e.g. MiniBatchKMeans for streaming fits"
+                )
+        if callable(embedding_chunks):
+            get_chunks=embedding_chunks
+        elif isinstance(embedding_chunks, (np.ndarray, pd.DataFrame)):
+            def get_chunks():
+                return self.iter_chunks(embedding_chunks, chunk_size)
+        elif isinstance(embedding_chunks, Iterator):
+            raise TypeError(
+                "embedding_chunks is read three times and can not be a "
+                "generator or iterator, pass a function that returns a new "
+                "generator instead, e.g. lambda: read_chunks(filepath)"
+                )
+        elif isinstance(embedding_chunks, Iterable):
+            def get_chunks():
+                return iter(embedding_chunks)
+        else:
+            raise TypeError(
+                f"embedding_chunks must be callable, iterable, an array or a "
+                f"DataFrame, got {type(embedding_chunks).__name__}"
+                )
+
+        if hasattr(self.scaler, "partial_fit"):
+            for ichunk in get_chunks():
+                self.scaler.partial_fit(self._as_array(ichunk))
+        else:
+            self.scaler.fit(self._reservoir_sample(get_chunks(),
+                                                   sample_size,
+                                                   random_state
+                                                   ))
+
+        for ichunk in get_chunks():
+            self.clustering.partial_fit(
+                self.scaler.transform(self._as_array(ichunk))
+                )
+
+        self.product_labels={}
+        for ichunk in get_chunks():
+            if isinstance(ichunk, pd.DataFrame):
+                self._add_product_labels(ichunk.index,
+                                         self.pipeline.predict(ichunk.values)
+                                         )
+
+    @staticmethod
+    def iter_chunks(embeddings, chunk_size):
+        for istart in range(0, len(embeddings), chunk_size):
+            if isinstance(embeddings, pd.DataFrame):
+                yield embeddings.iloc[istart:istart + chunk_size]
+            else:
+                yield embeddings[istart:istart + chunk_size]
+
+    @staticmethod
+    def _as_array(chunk):
+        if isinstance(chunk, pd.DataFrame):
+            return chunk.values
+        return np.asarray(chunk)
+
+    @staticmethod
+    def _reservoir_sample(chunks, sample_size, random_state=None):
+        rng=np.random.default_rng(random_state)
+        sample=None
+        num_seen=0
+        for ichunk in chunks:
+            ichunk=ProductShelf._as_array(ichunk)
+            if sample is None:
+                sample=np.empty((sample_size, ichunk.shape[1]),
+                                dtype=ichunk.dtype
+                                )
+            # fill the reservoir first, then replace rows with decreasing
+            # probability (algorithm R, vectorized per chunk)
+            num_free=max(min(sample_size - num_seen, len(ichunk)), 0)
+            sample[num_seen:num_seen + num_free]=ichunk[:num_free]
+
+            positions=np.arange(num_seen + num_free, num_seen + len(ichunk))
+            replace_at=(rng.random(len(positions)) * (positions + 1)) \
+                .astype(np.int64)
+            is_replaced=replace_at < sample_size
+            sample[replace_at[is_replaced]]=ichunk[num_free:][is_replaced]
+            num_seen+=len(ichunk)
+
+        if sample is None:
+            raise ValueError("No embeddings to fit the shelf on")
+        return sample[:min(num_seen, sample_size)]
+
+    def save_product_labels(self, filepath):
+        """
+        Store the product -> shelf table, scoring processes can label
+        products with it without the embeddings or the fitted pipeline.
+        """
+        np.savez(filepath,
+                 products=np.array(list(self.product_labels), dtype=str),
+                 labels=np.fromiter(self.product_labels.values(),
+                                    dtype=np.int32,
+                                    count=len(self.product_labels)
+                                    )
+                 )
+
+    @classmethod
+    def from_product_labels(cls, filepath):
+        shelf=cls()
+        with np.load(filepath) as product_labels:
+            shelf._add_product_labels(product_labels["products"].tolist(),
+                                      product_labels["labels"]
+                                      )
+        return shelf
+
+    def _add_product_labels(self, products, labels):
+        self.product_labels.update(zip(products, labels.tolist()))
+
+    def append_to_df(self, data, embeddings=None, skip_unknown=False):
+        """
+        Append the number of products per shelf to every company.
+
+        Every unique product is labeled once, the (company, label) pairs are
+        counted with a single bincount.
+
+        Parameters
+        ----------
+        data : pd.DataFrame
+            Company data with a ``product_categories`` column
+        embeddings : pd.DataFrame or QuantizedEmbeddings, optional
+            Embeddings of the products, indexed by the product. Only needed
+            for products that are not in ``product_labels``
+        skip_unknown : bool
+            Leave out products without shelf label and embedding instead of
+            raising a KeyError, e.g. for the embeddings of a
+            ``StaticVocabularyEncoder`` with ``on_unknown="skip"``
+
+        Returns
+        -------
+        pd.DataFrame
+            ``data`` with a ``product_label_<n>`` column for every shelf
+        """
+        company_pos, product_codes, products=self._company_products(
+            data.product_categories.values
+            )
+
         labeled_products=pd.DataFrame()
-        for icompany, idata in data.iterrows():
-            iproducts=list(idata.product_categories)
-            if iproducts==[]:
-                continue
-            ilabels=self.get_product_labels(iproducts, embeddings)
-
-            count_categories=np.unique(ilabels, return_counts=True)
-            labeled_products=pd.concat(
-                [labeled_products,
-                 pd.DataFrame(index=[icompany],
-                              columns=count_categories[0],
-                              data=count_categories[1].reshape(1, -1)
-                              )]
+        if len(product_codes):
+            product_labels=self.get_product_labels(list(products),
+                                                   embeddings,
+                                                   skip_unknown=skip_unknown
+                                                   )
+            is_labeled=product_labels[product_codes]!=self.unknown_label
+            company_pos=company_pos[is_labeled]
+            product_codes=product_codes[is_labeled]
+
+        if len(product_codes):
+            labels, label_codes=np.unique(product_labels,
+                                          return_inverse=True
+                                          )
+
+            label_counts=np.bincount(
+                company_pos * len(labels) + label_codes[product_codes],
+                minlength=len(data.index) * len(labels)
+                ).reshape(len(data.index), len(labels))
+
+            has_products=np.zeros(len(data.index), dtype=bool)
+            has_products[company_pos]=True
+            label_counts=label_counts[has_products]
+
+            # columns in order of their first appearance, rows are walked in
+            # order and the labels of each company are sorted
+            column_order=pd.unique(np.nonzero(label_counts)[1])
+            labeled_products=pd.DataFrame(
+                label_counts[:, column_order],
+                index=data.index[has_products],
+                columns=labels[column_order]
+                )
+            # labels missing for some companies were NaN before fillna
+            has_missing_labels=(label_counts[:, column_order]==0).any(axis=0)
+            labeled_products=labeled_products.astype(
+                {icolumn: float for icolumn in
+                 labeled_products.columns[has_missing_labels]}
                 )
 
         self._change_column_names(labeled_products)
         labeled_products.fillna(0, inplace=True)
         return pd.concat([data, labeled_products], axis=1)
 
+    @staticmethod
+    def _company_products(product_categories):
+        """
+        Company position and product code of every (company, product)
+        pair, plus the products the codes point to.
+        """
+        if isinstance(product_categories, ProductCategoriesArray):
+            # only the products that occur, the vocabulary may be shared
+            # with companies that are not in data
+            product_codes, used_codes=pd.factorize(product_categories.codes)
+            return (product_categories.company_positions(), product_codes,
+                    product_categories.vocabulary[used_codes])
+
+        exploded=pd.Series(product_categories).explode()
+        exploded=exploded[exploded.notna()]
+        product_codes, products=pd.factorize(exploded)
+        return exploded.index.to_numpy(), product_codes, products
+
     @staticmethod
     def _change_column_names(labeled_products):
         labeled_products.columns=['product_label_' + str(int(icolumns)) for
                                   icolumns in labeled_products.columns]
 
-    def get_product_labels(self, products, embeddings):
+    def get_product_labels(self, products, embeddings=None,
+                           skip_unknown=False):
+        """
+        Shelf label of every product. Products without a label are
+        predicted from ``embeddings``, products that are missing there too
+        get ``unknown_label`` if ``skip_unknown``, otherwise a KeyError is
+        raised.
+        """
         if not products:
             return np.ndarray([])
+
+        unknown_products=[iproduct for iproduct in dict.fromkeys(products)
+                          if iproduct not in self.product_labels]
+        if unknown_products:
+            embedded_products=[]
+            if embeddings is not None:
+                embedded_products=[iproduct for iproduct in unknown_products
+                                   if iproduct in embeddings.index]
+            if len(embedded_products) < len(unknown_products) and \
+                    not skip_unknown:
+                embedded=set(embedded_products)
+                not_embedded=[iproduct for iproduct in unknown_products if
+                              iproduct not in embedded]
+                raise KeyError(
+                    f"{len(not_embedded)} products have no shelf label "
+                    f"and no embeddings, e.g. {not_embedded[:3]}"
+                    )
+            if embedded_products:
+                self._add_product_labels(
+                    embedded_products,
+                    self._predict(embedded_products, embeddings)
+                    )
+
+        return np.fromiter(
+            (self.product_labels.get(iproduct, self.unknown_label) for
+             iproduct in products),
+            dtype=int,
+            count=len(products)
+            )
+
+    def _predict(self, products, embeddings):
+        if isinstance(embeddings, QuantizedEmbeddings):
+            return self.pipeline.predict(embeddings.lookup(products))
         return self.pipeline.predict(embeddings.loc[products, :])
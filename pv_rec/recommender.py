@@ -1,20 +1,42 @@
 import pandas as pd
+import sys
 import time
 
 from matplotlib import pyplot as plt
 import matplotlib as mpl
 import numpy as np
 
-from scipy.cluster.hierarchy import dendrogram, linkage, fcluster, cut_tree
+from scipy.cluster.hierarchy import dendrogram, linkage, fcluster, cut_tree, \
+    optimal_leaf_ordering
 from scipy.cluster import hierarchy
-from scipy.spatial.distance import euclidean
+from sklearn.metrics import adjusted_rand_score
 from sklearn.preprocessing import MinMaxScaler
 
 from structlog import get_logger
 
+from pv_rec.clustering import micro_cluster, ward_linkage
+from pv_rec.scoring import ORDINAL_MAPS, CentroidScorer, ScoringArtifact, \
+    map_ordinal_data, prepare_companies
+
 
 log=get_logger()
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource=None
+
+
+def _peak_rss_mb():
+    """Peak resident set size of the process so far in MB."""
+    if resource is None:
+        return None
+    peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform=="darwin":
+        return peak_rss / 1024**2
+    return peak_rss / 1024
+
 
 class Recommender:
     def __init__(self):
@@ -27,77 +49,162 @@ class Recommender:
         self.column_shema=None
         self.label_averages=None
         self.pv_affinity_scores=None
+        self.scorer=None
+
+        # kept from fit for cut line sweeps, the scaled features are not
+        # kept and recomputed from ml_data when they are needed
+        self.is_mastr=None
+        self.leaf_labels=None
+        self.leaf_data=None
+        self.ordered_model=None
+
+        # state at fit time, online updates are compared against it
+        self.fit_label_averages=None
+        self.fit_total_companies=None
+        self.updated_companies=set()
 
     def fit(self, wlw_data: pd.DataFrame, mastr_data: pd.DataFrame,
             mapping_needed: bool=True,
-            method='ward', metric='euclidean'):
+            method='ward', metric='euclidean',
+            linkage_engine: str='scipy',
+            n_micro_clusters: int=None,
+            report_agreement: bool=False,
+            random_state=None,
+            optimal_ordering: bool=False,
+            low_memory: bool=False):
         """
         Fit the recommender model using the provided company data.
 
         :param products:
+        :param linkage_engine: "scipy" uses scipy's linkage, which needs the
+            O(n²) distance matrix. "nn_chain" computes ward/euclidean
+            linkages on the feature vectors with O(n·d) memory.
+        :param n_micro_clusters: if given, the companies are first compressed
+            into this many micro-clusters with mini-batch k-means and the
+            weighted ward linkage is built on their centroids. More
+            micro-clusters give results closer to the exact fit.
+        :param report_agreement: also run the exact linkage and log the
+            adjusted rand index of the approximate labels against it
+        :param random_state: seed of the micro-clustering
+        :param optimal_ordering: reorder the leaves while fitting and take
+            the cluster labels from the ordered tree, like before the
+            ordering became lazy. By default ``plot`` computes the ordering
+            when it is needed, the clusters are the same but fcluster
+            numbers them in a different order.
+        :param low_memory: build one float32 feature matrix from both
+            frames instead of copying and aligning them with
+            ``combine_first``. ``ml_data`` is a view on that matrix, and the
+            ``source`` column is not written into the passed frames.
         :return:
         """
+        if linkage_engine not in ('scipy', 'nn_chain'):
+            raise ValueError(f"Unknown linkage_engine {linkage_engine}, use "
+                             f"'scipy' or 'nn_chain'")
+        if (linkage_engine=='nn_chain' or n_micro_clusters is not None) \
+                and (method!='ward' or metric!='euclidean'):
+            raise ValueError("The nn_chain linkage engine and micro-clusters "
+                             "only support method='ward' with "
+                             "metric='euclidean'")
+        if n_micro_clusters is not None and n_micro_clusters < 2:
+            raise ValueError(f"n_micro_clusters must be at least 2, got "
+                             f"{n_micro_clusters}")
+
         start_time=time.time()
-        log.info("Preparing data")
-        if 'product_categories' in wlw_data.columns or \
-           'product_categories' in mastr_data.columns:
-            log.info("Dropping product categories")
-            data_a=mastr_data.drop(['product_categories'], axis=1).copy()
-            data_b=wlw_data.drop(['product_categories'], axis=1).copy()
+        log.info("Preparing data", low_memory=low_memory)
+        if low_memory:
+            self.ml_data=self._prepare_low_memory(wlw_data, mastr_data,
+                                                  mapping_needed
+                                                  )
         else:
-            data_a=mastr_data.copy()
-            data_b=wlw_data.copy()
-
-        self.ml_data=data_a.combine_first(data_b).copy()
-        self.ml_data.sort_index(inplace=True, axis=1)
-
-        # for later identification
-        mastr_data["source"]="mastr"
-        wlw_data["source"]="wlw"
-
-        if mapping_needed:
-            log.info("Map categorical data")
-            self.ml_data=self._map_ordinal_data(self.ml_data)
-
-        log.info("handle NaNs")
-        self.ml_data.fillna(0, inplace=True)
+            self.ml_data=self._prepare_data(wlw_data, mastr_data,
+                                            mapping_needed
+                                            )
 
         log.info("Scaling data")
         self.scaler.fit(self.ml_data)
         scaled_ml=self.scaler.transform(self.ml_data)
+        self.is_mastr=self.ml_data.index.isin(mastr_data.index)
+        log.info("Data prepared", duration=time.time() - start_time,
+                 peak_rss_mb=_peak_rss_mb()
+                 )
+
+        stage_start_time=time.time()
+        self.leaf_labels=None
+        self.leaf_data=None
+        self.ordered_model=None
+        if n_micro_clusters is None:
+            log.info("create linkage tree", engine=linkage_engine)
+            self.model=self._build_linkage(scaled_ml, method, metric,
+                                           linkage_engine
+                                           )
+        else:
+            log.info("Compress companies into micro-clusters",
+                     n_micro_clusters=n_micro_clusters
+                     )
+            micro_labels, centroids, weights=micro_cluster(
+                scaled_ml, n_micro_clusters, random_state=random_state
+                )
+            if len(centroids) < 2:
+                raise ValueError(
+                    f"n_micro_clusters={n_micro_clusters} compressed the "
+                    f"companies into {len(centroids)} micro-cluster, a "
+                    f"linkage needs at least 2. Fit without n_micro_clusters "
+                    f"for data this small or this uniform."
+                    )
 
-        log.info("create linkage tree")
-        self.model=linkage(scaled_ml,
-                           method=method, metric=metric,
-                           optimal_ordering=True
-                           )
+            log.info("create linkage tree of micro-clusters")
+            self.model=ward_linkage(centroids, sample_weight=weights)
+            self.leaf_labels=micro_labels
+            self.leaf_data=centroids
+
+        cluster_model=self.model
+        if optimal_ordering:
+            ordering_start_time=time.time()
+            # fcluster numbers the clusters along the leaves, labels from
+            # the ordered tree match the dendrogram of plot
+            cluster_model=self._get_ordered_model()
+            log.info("Optimal leaf ordering computed",
+                     duration=time.time() - ordering_start_time
+                     )
 
         log.info("Get cluster labels")
-        cluster_labels=fcluster(self.model,
+        cluster_labels=fcluster(cluster_model,
                                 t=self.cut_line,
                                 criterion='distance'
                                 )
+        if self.leaf_labels is not None:
+            cluster_labels=cluster_labels[self.leaf_labels]
+
+            if report_agreement:
+                exact_labels=fcluster(
+                    self._build_linkage(scaled_ml, method, metric,
+                                        linkage_engine
+                                        ),
+                    t=self.cut_line,
+                    criterion='distance'
+                    )
+                log.info("Agreement with exact fit",
+                         adjusted_rand_score=adjusted_rand_score(
+                             exact_labels, cluster_labels
+                             ),
+                         n_clusters=len(np.unique(cluster_labels)),
+                         n_clusters_exact=len(np.unique(exact_labels))
+                         )
         self.ml_data["labels"]=cluster_labels
+        log.info("Linkage tree and cluster labels created",
+                 duration=time.time() - stage_start_time,
+                 peak_rss_mb=_peak_rss_mb()
+                 )
 
         log.info("Get number of Mastr companies in clusters")
-        results={}
-        for icluster_num in self.ml_data.labels:
-            companies_in_cluster=self.ml_data[
-                self.ml_data["labels"]==icluster_num].copy()
-            num_mastr_companises=companies_in_cluster.index.intersection(
-                mastr_data.index
-                )
-
-            results[f"cluster_{icluster_num}"]={
-                'total_companies': len(companies_in_cluster.index),
-                'mastr_data': len(num_mastr_companises),
-                'percent': len(num_mastr_companises) / len(
-                    companies_in_cluster.index
-                    )
-                }
-
-        log.info("Get PV affinity scores")
-        self.pv_affinity_scores=pd.DataFrame(results).T
+        affinity_start_time=time.time()
+        self.pv_affinity_scores=self._calc_pv_affinity_scores(
+            self.ml_data.labels.values,
+            self.is_mastr
+            )
+        log.info("Get PV affinity scores",
+                 duration=time.time() - affinity_start_time
+                 )
 
         end_time=time.time()
         log.info("Model fitted", duration=end_time - start_time)
@@ -106,68 +213,396 @@ class Recommender:
         self.column_shema=self.ml_data.columns
 
         log.info("get all feature averages for clusters")
-        self.label_averages=pd.concat([
-            pd.DataFrame(
-                scaled_ml,
-                columns=self.ml_data.columns[:-1],
-                index=self.ml_data.index
-                ),
-            self.ml_data.labels], axis=1
-            ).groupby('labels').mean()
+        stage_start_time=time.time()
+        self.label_averages=self._label_averages(scaled_ml,
+                                                 self.ml_data.labels.values,
+                                                 self.ml_data.columns[:-1]
+                                                 )
+        log.info("Feature averages computed",
+                 duration=time.time() - stage_start_time,
+                 peak_rss_mb=_peak_rss_mb()
+                 )
+
+        log.info("Build centroid scorer")
+        self.scorer=CentroidScorer.from_recommender(self.label_averages,
+                                                    self.pv_affinity_scores
+                                                    )
+        self.fit_label_averages=self.label_averages.copy()
+        self.fit_total_companies=self._cluster_totals()
+        self.updated_companies=set()
 
         return self.pv_affinity_scores
 
-    def recommend(self, company_data: pd.DataFrame, mapping_needed: bool=True):
-        new_company=company_data.copy()
+    def update(self, new_mastr: pd.DataFrame, new_wlw: pd.DataFrame,
+               mapping_needed: bool=True, max_centroid_shift: float=0.1,
+               max_new_share: float=0.5):
+        """
+        Add new companies to the fitted clusters without refitting.
+
+        The companies are scaled with the fitted scaler and assigned to the
+        closest cluster. The company counts, ``pv_affinity_scores`` and the
+        running means in ``label_averages`` of the touched clusters are
+        updated, which costs O(batch). The linkage tree, ``ml_data`` and the
+        scaler keep their state from ``fit``.
+
+        :param new_mastr: new Mastr companies, like the data passed to fit
+        :param new_wlw: new WLW companies, like the data passed to fit
+        :param mapping_needed: map the ordinal columns
+        :param max_centroid_shift: a cluster is flagged for a refit if its
+            centroid moved further than this (scaled space) since fit
+        :param max_new_share: a cluster is flagged for a refit if more than
+            this share of its companies was added after fit
+        :return: drift report of the clusters that got new companies
+        """
+        start_time=time.time()
+        # merged like in fit, a company in both frames keeps its Mastr
+        # values and counts as Mastr company
+        new_companies=new_mastr.drop(columns='product_categories',
+                                     errors='ignore'
+                                     ) \
+            .combine_first(new_wlw.drop(columns='product_categories',
+                                        errors='ignore'
+                                        ))
+        is_new_mastr=new_companies.index.isin(new_mastr.index)
+
+        # get_indexer reuses the hash table of the fitted index, so this
+        # stays O(batch)
+        is_known=(self.ml_data.index.get_indexer(new_companies.index) >= 0) \
+            | np.array([icompany in self.updated_companies for icompany in
+                        new_companies.index], dtype=bool)
+        if is_known.any():
+            log.info("Skipping companies that are already in the model",
+                     known=int(is_known.sum())
+                     )
+            new_companies=new_companies[~is_known]
+            is_new_mastr=is_new_mastr[~is_known]
+        self.updated_companies.update(new_companies.index)
+
+        new_scaled=np.empty((0, self.label_averages.shape[1]))
+        if not new_companies.empty:
+            new_scaled=self.scaler.transform(prepare_companies(
+                new_companies,
+                columns=self.column_shema,
+                ordinal_maps=ORDINAL_MAPS,
+                mapping_needed=mapping_needed
+                ))
+        positions=self.scorer.nearest_centroid(new_scaled)
+
+        log.info("Update cluster statistics")
+        num_clusters=len(self.label_averages.index)
+        new_totals=np.bincount(positions, minlength=num_clusters)
+        new_mastr_counts=np.bincount(positions, weights=is_new_mastr,
+                                     minlength=num_clusters
+                                     )
+        new_sums=np.zeros(self.label_averages.shape)
+        np.add.at(new_sums, positions, new_scaled)
+
+        cluster_rows=[f"cluster_{icluster}" for icluster in
+                      self.label_averages.index]
+        totals=self._cluster_totals()
+        updated_totals=totals + new_totals
+        self.label_averages.loc[:, :]= \
+            (self.label_averages.values * totals[:, None] + new_sums) \
+            / updated_totals[:, None]
+
+        mastr_counts=self.pv_affinity_scores.loc[cluster_rows,
+                                                 'mastr_data'].values
+        self.pv_affinity_scores.loc[cluster_rows, 'total_companies']= \
+            updated_totals
+        self.pv_affinity_scores.loc[cluster_rows, 'mastr_data']= \
+            mastr_counts + new_mastr_counts
+        self.pv_affinity_scores.loc[cluster_rows, 'percent']= \
+            (mastr_counts + new_mastr_counts) / updated_totals
+
+        self.scorer=CentroidScorer.from_recommender(self.label_averages,
+                                                    self.pv_affinity_scores
+                                                    )
+
+        drift=pd.DataFrame(
+            {'new_companies': updated_totals - self.fit_total_companies,
+             'new_share': 1 - self.fit_total_companies / updated_totals,
+             'centroid_shift': np.linalg.norm(
+                 self.label_averages.values
+                 - self.fit_label_averages.values, axis=1
+                 ),
+             'percent': self.pv_affinity_scores.loc[cluster_rows,
+                                                    'percent'].values},
+            index=cluster_rows
+            )
+        drift['refit_due']=(drift.centroid_shift > max_centroid_shift) | \
+            (drift.new_share > max_new_share)
+        drift=drift[new_totals > 0]
+
+        log.info("Recommender updated",
+                 new_companies=len(new_companies.index),
+                 refit_due=int(drift.refit_due.sum()),
+                 duration=time.time() - start_time
+                 )
+        return drift
+
+    def _cluster_totals(self):
+        return self.pv_affinity_scores.loc[
+            [f"cluster_{icluster}" for icluster in self.label_averages.index],
+            'total_companies'
+            ].values
+
+    @staticmethod
+    def _calc_pv_affinity_scores(labels, is_mastr):
+        """
+        Count the companies and Mastr companies of every cluster, the
+        clusters are ordered by their first occurrence in ``labels``.
+        """
+        cluster_ids, first_index, cluster_index=np.unique(
+            labels, return_index=True, return_inverse=True
+            )
+        total_companies=np.bincount(cluster_index).astype(float)
+        mastr_companies=np.bincount(cluster_index, weights=is_mastr)
+
+        order=np.argsort(first_index)
+        return pd.DataFrame(
+            {'total_companies': total_companies[order],
+             'mastr_data': mastr_companies[order],
+             'percent': mastr_companies[order] / total_companies[order]},
+            index=[f"cluster_{icluster_num}" for icluster_num in
+                   cluster_ids[order]]
+            )
+
+    def _prepare_data(self, wlw_data, mastr_data, mapping_needed):
+        if 'product_categories' in wlw_data.columns or \
+           'product_categories' in mastr_data.columns:
+            log.info("Dropping product categories")
+            data_a=mastr_data.drop(['product_categories'], axis=1).copy()
+            data_b=wlw_data.drop(['product_categories'], axis=1).copy()
+        else:
+            data_a=mastr_data.copy()
+            data_b=wlw_data.copy()
+
+        ml_data=data_a.combine_first(data_b).copy()
+        ml_data.sort_index(inplace=True, axis=1)
+
+        # for later identification
+        mastr_data["source"]="mastr"
+        wlw_data["source"]="wlw"
 
         if mapping_needed:
-            log.info("map categorical data")
-            new_company=self._map_ordinal_data(new_company)
+            log.info("Map categorical data")
+            ml_data=self._map_ordinal_data(ml_data)
 
-        log.info("handle nans")
-        new_company.fillna(0, inplace=True)
+        log.info("handle NaNs")
+        ml_data.fillna(0, inplace=True)
+        return ml_data
 
-        log.info("set columns in correct order")
-        if "product_categories" in new_company.columns:
-            new_company.drop("product_categories", axis=1, inplace=True)
+    @staticmethod
+    def _prepare_low_memory(wlw_data, mastr_data, mapping_needed):
+        """
+        Same result as ``_prepare_data`` (in float32), written column by
+        column into one preallocated matrix.
+
+        The rows are the union of both indexes in the order
+        ``combine_first`` would give them. WLW values are written first and
+        the non-missing Mastr values on top, so a company in both frames
+        keeps its Mastr values like with ``combine_first``. Anything still
+        missing stays 0.
+        """
+        columns=sorted(set(mastr_data.columns).union(wlw_data.columns)
+                       - {'product_categories'}
+                       )
+        index=mastr_data.index.union(wlw_data.index)
+        feature_matrix=np.zeros((len(index), len(columns)), dtype=np.float32)
+
+        for idata in [wlw_data, mastr_data]:
+            irows=index.get_indexer(idata.index)
+            is_mastr=idata is mastr_data
+            for jcolumn, icolumn in enumerate(columns):
+                if icolumn not in idata.columns:
+                    continue
+                ivalues=idata[icolumn]
+                if mapping_needed and icolumn in ORDINAL_MAPS:
+                    ivalues=ivalues.map(ORDINAL_MAPS[icolumn])
+                ivalues=ivalues.to_numpy(dtype=np.float32, na_value=np.nan)
+                if is_mastr:
+                    is_present=~np.isnan(ivalues)
+                    feature_matrix[irows[is_present], jcolumn]= \
+                        ivalues[is_present]
+                else:
+                    feature_matrix[irows, jcolumn]=np.nan_to_num(ivalues,
+                                                                 nan=0
+                                                                 )
+
+        return pd.DataFrame(feature_matrix, index=index, columns=columns,
+                            copy=False
+                            )
+
+    @staticmethod
+    def _label_averages(scaled_ml, labels, columns):
+        """Mean of the scaled features of every cluster."""
+        cluster_labels, positions=np.unique(labels, return_inverse=True)
+        counts=np.bincount(positions)
+        sums=np.empty((len(cluster_labels), scaled_ml.shape[1]))
+        for jcolumn in range(scaled_ml.shape[1]):
+            sums[:, jcolumn]=np.bincount(positions,
+                                         weights=scaled_ml[:, jcolumn],
+                                         minlength=len(cluster_labels)
+                                         )
+        return pd.DataFrame(sums / counts[:, None],
+                            index=pd.Index(cluster_labels, name='labels'),
+                            columns=columns
+                            )
+
+    @staticmethod
+    def _build_linkage(scaled_ml, method, metric, linkage_engine):
+        if linkage_engine=='nn_chain':
+            return ward_linkage(scaled_ml)
+        return linkage(scaled_ml, method=method, metric=metric)
+
+    def _get_ordered_model(self):
+        """
+        Linkage with optimally ordered leaves, computed on first use and
+        cached. The merges are the same as in ``self.model``, only the
+        order of the leaves in the dendrogram changes.
+        """
+        if self.ordered_model is None:
+            leaf_data=self.leaf_data
+            if leaf_data is None:
+                leaf_data=self._scaled_features()
+            self.ordered_model=optimal_leaf_ordering(self.model, leaf_data)
+        return self.ordered_model
+
+    def _scaled_features(self):
+        """Scaled features of the fitted companies, recomputed from
+        ``ml_data``."""
+        return self.scaler.transform(
+            self.ml_data.drop(columns='labels', errors='ignore')
+            )
 
-        for column in self.column_shema:
-            if column not in new_company.columns and \
-                column!="labels":
-                new_company[column]=0
-        new_company=new_company.reindex(sorted(new_company.columns), axis=1)
+    def recommend(self, company_data: pd.DataFrame, mapping_needed: bool=True):
+        new_company=prepare_companies(company_data,
+                                      columns=self.column_shema,
+                                      ordinal_maps=ORDINAL_MAPS,
+                                      mapping_needed=mapping_needed
+                                      )
 
         log.info("scale data")
         new_company_scaled=self.scaler.transform(new_company)
         # new_company_scaled = new_company_scaled[]
 
         log.info("Get closest cluster to new data")
-        closest_cluster=[]
-        for inew_company in new_company_scaled:
-            distance=[euclidean(inew_company, label_avg) for label_avg in
-                      self.label_averages.values]
-            closest_cluster.append(np.argmin(distance))
-
+        # the scorer maps centroid positions to the fcluster labels, which
+        # start at 1, so every company gets a cluster
+        closest_cluster, pv_affinity=self.scorer.score(new_company_scaled)
         new_company['labels']=closest_cluster
-        # 0 means no cluster found
-        # ToDo: find out why this happens, there should always be a cluster
-        new_company=new_company[new_company.labels!=0]
 
-        pv_affinity=[self.calc_pv_affinity_score(icluster)
-                     for icluster in new_company.labels]
         pv_affinity=pd.DataFrame(pv_affinity, index=new_company.index,
                                  columns=['pv_affinity']
                                  )
 
         return pv_affinity, new_company
 
+    def export_artifact(self, filepath, product_shelf=None):
+        """
+        Write everything ``recommend`` needs into a compact npz artifact,
+        see ``scoring.ScoringArtifact``.
+
+        :param filepath: path of the npz file
+        :param product_shelf: optional fitted ``ProductShelf``, its product
+            -> shelf table is stored so that the artifact can label the
+            products of new companies itself
+        """
+        product_labels=None
+        if product_shelf is not None:
+            product_labels=product_shelf.product_labels
+        artifact=ScoringArtifact(
+            columns=[icolumn for icolumn in self.column_shema if
+                     icolumn!="labels"],
+            scale=self.scaler.scale_,
+            min=self.scaler.min_,
+            clip=self.scaler.clip,
+            scorer=self.scorer,
+            ordinal_maps=ORDINAL_MAPS,
+            product_labels=product_labels
+            )
+        artifact.save(filepath)
+        return artifact
+
+    def sweep_cut_lines(self, heights=None, n_clusters=None,
+                        holdout_data: pd.DataFrame=None,
+                        mapping_needed: bool=True, threshold: float=0.5):
+        """
+        Evaluate many cut lines on the fitted linkage tree in one pass.
+
+        All cuts are taken from the existing ``self.model`` with a single
+        ``cut_tree`` call, the cluster sizes, affinities and centroids of
+        every cut are computed with bincounts over the labels.
+
+        :param heights: cut lines (distances) to evaluate
+        :param n_clusters: numbers of clusters to evaluate, alternative to
+            ``heights``
+        :param holdout_data: optional companies (like ``recommend`` takes
+            them) that should get a high affinity, used for the recall
+        :param mapping_needed: map the ordinal columns of ``holdout_data``
+        :param threshold: affinity threshold of the recall
+        :return: one row per cut with the number of clusters, the
+            distribution of the company affinities and the holdout recall
+        """
+        if (heights is None)==(n_clusters is None):
+            raise ValueError("Pass either heights or n_clusters")
+        cuts=heights if heights is not None else n_clusters
+
+        log.info("Cut linkage tree", n_cuts=len(cuts))
+        start_time=time.time()
+        if heights is not None:
+            all_labels=cut_tree(self.model, height=heights)
+        else:
+            all_labels=cut_tree(self.model, n_clusters=n_clusters)
+        if self.leaf_labels is not None:
+            all_labels=all_labels[self.leaf_labels]
+
+        holdout_scaled=None
+        scaled_ml=None
+        if holdout_data is not None:
+            scaled_ml=self._scaled_features()
+            holdout_scaled=self.scaler.transform(prepare_companies(
+                holdout_data,
+                columns=self.column_shema,
+                ordinal_maps=ORDINAL_MAPS,
+                mapping_needed=mapping_needed
+                ))
+
+        results=[]
+        for icut, ilabels in zip(cuts, all_labels.T):
+            icluster_sizes=np.bincount(ilabels)
+            iaffinities=np.bincount(ilabels, weights=self.is_mastr) \
+                / icluster_sizes
+            icompany_affinities=iaffinities[ilabels]
+
+            iresult={
+                'cut': icut,
+                'n_clusters': len(icluster_sizes),
+                'affinity_mean': icompany_affinities.mean(),
+                'affinity_q10': np.quantile(icompany_affinities, 0.1),
+                'affinity_median': np.median(icompany_affinities),
+                'affinity_q90': np.quantile(icompany_affinities, 0.9),
+                }
+            if holdout_scaled is not None:
+                icentroids=np.zeros((len(icluster_sizes),
+                                     scaled_ml.shape[1]))
+                np.add.at(icentroids, ilabels, scaled_ml)
+                icentroids/=icluster_sizes[:, None]
+
+                _, iholdout_affinities=CentroidScorer(
+                    icentroids, iaffinities, np.arange(len(icluster_sizes))
+                    ).score(holdout_scaled)
+                iresult['recall']=np.mean(iholdout_affinities >= threshold)
+            results.append(iresult)
+
+        log.info("Cut lines evaluated", duration=time.time() - start_time)
+        return pd.DataFrame(results).set_index('cut')
+
     def calc_pv_affinity_score(self, cluster_number):
         return self.pv_affinity_scores \
                    .loc[f'cluster_{cluster_number}', :].percent
 
-    def recall(self, affinity):
-        threshold=0.5
-
+    def recall(self, affinity, threshold: float=0.5):
         p=len(affinity)
         tp=np.sum(affinity.pv_affinity >= threshold)
         fn=np.sum(affinity.pv_affinity < threshold)
@@ -178,35 +613,7 @@ class Recommender:
         return recall
 
     def _map_ordinal_data(self, data: pd.DataFrame):
-        distribution_area_map={
-            "unknown": 0,
-            "Lokal": 1,
-            "Regional": 2,
-            "National": 3,
-            "Europa": 4,
-            "Weltweit": 5
-            }
-        employee_count_map={
-            "unknown": 0,
-            "1-4": 1,
-            "5-9": 2,
-            "10-19": 3,
-            "20-49": 4,
-            "50-99": 5,
-            "100-199": 6,
-            "200-499": 7,
-            "500-999": 8,
-            "1000+": 9,
-            }
-
-        data.loc[:, 'distribution_area']=data['distribution_area'].map(
-            distribution_area_map
-            )
-        data.loc[:, 'employee_count']=data['employee_count'].map(
-            employee_count_map
-            )
-
-        return data
+        return map_ordinal_data(data, ORDINAL_MAPS)
 
     # %% plots
     def plot(self):
@@ -218,7 +625,8 @@ class Recommender:
         fig, ax=plt.subplots(figsize=(12, 7), ncols=1, nrows=2,
                              gridspec_kw={'height_ratios': [0.6, 0.4]}
                              )
-        dendrogram(self.model,
+        ordered_model=self._get_ordered_model()
+        dendrogram(ordered_model,
                    truncate_mode='level',
                    no_labels=True,
                    color_threshold=self.cut_line,
@@ -227,7 +635,7 @@ class Recommender:
         ax[0].hlines(self.cut_line, -1, 30000, 'grey', linewidth=1.5,
                      linestyles='--'
                      )
-        dendrogram(self.model,
+        dendrogram(ordered_model,
                    truncate_mode='level',
                    no_labels=True,
                    color_threshold=self.cut_line,
@@ -0,0 +1,285 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from structlog import get_logger
+
+
+log=get_logger()
+
+ORDINAL_MAPS={
+    "distribution_area": {
+        "unknown": 0,
+        "Lokal": 1,
+        "Regional": 2,
+        "National": 3,
+        "Europa": 4,
+        "Weltweit": 5
+        },
+    "employee_count": {
+        "unknown": 0,
+        "1-4": 1,
+        "5-9": 2,
+        "10-19": 3,
+        "20-49": 4,
+        "50-99": 5,
+        "100-199": 6,
+        "200-499": 7,
+        "500-999": 8,
+        "1000+": 9,
+        }
+    }
+
+
+def map_ordinal_data(data: pd.DataFrame, ordinal_maps: dict):
+    for icolumn, imap in ordinal_maps.items():
+        data.loc[:, icolumn]=data[icolumn].map(imap)
+    return data
+
+
+def prepare_companies(company_data: pd.DataFrame, columns, ordinal_maps,
+                      mapping_needed: bool=True):
+    """
+    Bring new companies into the feature layout the recommender was fitted
+    on (ordinal mapping, NaN handling, missing columns, column order).
+    """
+    new_company=company_data.copy()
+
+    if mapping_needed:
+        log.info("map categorical data")
+        new_company=map_ordinal_data(new_company, ordinal_maps)
+
+    # dropped before fillna, the categories are no feature and their
+    # missing values can not be filled with 0
+    if "product_categories" in new_company.columns:
+        new_company.drop("product_categories", axis=1, inplace=True)
+
+    log.info("handle nans")
+    new_company.fillna(0, inplace=True)
+
+    log.info("set columns in correct order")
+    for column in columns:
+        if column not in new_company.columns and \
+            column!="labels":
+            new_company[column]=0
+    return new_company.reindex(sorted(new_company.columns), axis=1)
+
+
+class CentroidScorer:
+    """
+    Assigns companies to the closest cluster centroid and looks up the PV
+    affinity of that cluster.
+
+    The centroids are held as one contiguous float32 matrix, the affinities
+    and cluster labels as arrays in the same order. Distances are computed
+    for a whole batch at once. With many clusters in a low dimensional
+    space a KD-tree is queried instead, in higher dimensions the tree is
+    slower than the matrix product.
+
+    Parameters
+    ----------
+    centroids : np.ndarray
+        Cluster centroids in the scaled feature space, one row per cluster
+    affinities : np.ndarray
+        PV affinity score of every cluster
+    cluster_labels : np.ndarray
+        Cluster label (as returned by fcluster) of every centroid
+    batch_size : int
+        Number of companies per distance computation
+    """
+    kd_tree_min_clusters=1024
+    kd_tree_max_features=10
+
+    def __init__(self, centroids, affinities, cluster_labels,
+                 batch_size=8192):
+        self.centroids=np.ascontiguousarray(centroids, dtype=np.float32)
+        self.affinities=np.asarray(affinities, dtype=np.float64)
+        self.cluster_labels=np.asarray(cluster_labels)
+        self.batch_size=batch_size
+
+        self._squared_norms=(self.centroids**2).sum(axis=1)
+        self._tree=None
+        if len(self.centroids) >= self.kd_tree_min_clusters and \
+                self.centroids.shape[1] <= self.kd_tree_max_features:
+            # scipy is only imported when the tree is used, scoring
+            # processes start faster without it
+            from scipy.spatial import cKDTree
+
+            self._tree=cKDTree(self.centroids)
+
+    @classmethod
+    def from_recommender(cls, label_averages, pv_affinity_scores, **kwargs):
+        """
+        Build the scorer from the ``label_averages`` and
+        ``pv_affinity_scores`` of a fitted ``Recommender``.
+        """
+        cluster_labels=label_averages.index.values
+        affinities=pv_affinity_scores.loc[
+            [f"cluster_{icluster}" for icluster in cluster_labels],
+            "percent"
+            ].values
+        return cls(label_averages.values, affinities, cluster_labels,
+                   **kwargs)
+
+    def nearest_centroid(self, scaled_data):
+        """Position of the closest centroid for every row."""
+        scaled_data=np.asarray(scaled_data, dtype=np.float32)
+        positions=np.empty(len(scaled_data), dtype=np.int64)
+        for istart in range(0, len(scaled_data), self.batch_size):
+            ibatch=scaled_data[istart:istart + self.batch_size]
+            if self._tree is not None:
+                _, positions[istart:istart + len(ibatch)]= \
+                    self._tree.query(ibatch)
+            else:
+                # ||x||² is the same for every centroid and can be left out
+                idistances=self._squared_norms - 2 * ibatch @ self.centroids.T
+                positions[istart:istart + len(ibatch)]= \
+                    np.argmin(idistances, axis=1)
+        return positions
+
+    def score(self, scaled_data):
+        """
+        Cluster labels and PV affinities of the (already scaled) companies.
+        """
+        positions=self.nearest_centroid(scaled_data)
+        return self.cluster_labels[positions], self.affinities[positions]
+
+
+class ScoringArtifact:
+    """
+    Everything needed to score new companies with a fitted ``Recommender``.
+
+    The artifact holds the parameters of the ``MinMaxScaler``, the column
+    schema, the centroid scorer, the ordinal maps and optionally the
+    product -> shelf table. It is stored as a plain npz file, loading it
+    neither needs the company data nor scipy's hierarchy or matplotlib.
+
+    Parameters
+    ----------
+    columns : list
+        Feature columns in the order the scaler was fitted on
+    scale, min : np.ndarray
+        ``scale_`` and ``min_`` of the fitted ``MinMaxScaler``
+    clip : bool
+        ``clip`` of the ``MinMaxScaler``
+    scorer : CentroidScorer
+        Centroids, affinities and cluster labels
+    ordinal_maps : dict
+        Column -> {category: ordinal value}
+    product_labels : dict, optional
+        Product -> shelf label of a fitted ``ProductShelf``
+    """
+    version=1
+
+    def __init__(self, columns, scale, min, clip, scorer, ordinal_maps,
+                 product_labels=None):
+        self.columns=list(columns)
+        self.scale=np.asarray(scale, dtype=np.float64)
+        self.min=np.asarray(min, dtype=np.float64)
+        self.clip=bool(clip)
+        self.scorer=scorer
+        self.ordinal_maps=ordinal_maps
+        self.product_labels=product_labels
+
+    def save(self, filepath):
+        arrays={
+            "version": np.array(self.version),
+            "columns": np.array(self.columns, dtype=str),
+            "scale": self.scale,
+            "min": self.min,
+            "clip": np.array(self.clip),
+            "centroids": self.scorer.centroids,
+            "affinities": self.scorer.affinities,
+            "cluster_labels": self.scorer.cluster_labels,
+            "ordinal_maps": np.array(json.dumps(self.ordinal_maps)),
+            }
+        if self.product_labels is not None:
+            arrays["products"]=np.array(list(self.product_labels), dtype=str)
+            arrays["product_shelves"]=np.fromiter(
+                self.product_labels.values(),
+                dtype=np.int32,
+                count=len(self.product_labels)
+                )
+        np.savez(filepath, **arrays)
+
+    @classmethod
+    def load(cls, filepath):
+        with np.load(filepath, allow_pickle=False) as arrays:
+            if int(arrays["version"])!=cls.version:
+                raise ValueError(
+                    f"Artifact version {int(arrays['version'])} is not "
+                    f"supported, expected version {cls.version}"
+                    )
+            product_labels=None
+            if "products" in arrays:
+                product_labels=dict(zip(arrays["products"].tolist(),
+                                        arrays["product_shelves"].tolist()
+                                        ))
+            return cls(columns=arrays["columns"].tolist(),
+                       scale=arrays["scale"],
+                       min=arrays["min"],
+                       clip=bool(arrays["clip"]),
+                       scorer=CentroidScorer(arrays["centroids"],
+                                             arrays["affinities"],
+                                             arrays["cluster_labels"]
+                                             ),
+                       ordinal_maps=json.loads(str(arrays["ordinal_maps"])),
+                       product_labels=product_labels
+                       )
+
+    def transform(self, new_company: pd.DataFrame):
+        """Scale prepared companies like ``MinMaxScaler.transform``."""
+        scaled=new_company[self.columns].to_numpy(dtype=np.float64) \
+            * self.scale + self.min
+        if self.clip:
+            np.clip(scaled, 0, 1, out=scaled)
+        return scaled
+
+    def label_products(self, company_data: pd.DataFrame,
+                       skip_unknown: bool=True):
+        """
+        Append the ``product_label_<n>`` columns from the shelf table.
+        Products that are not in the table are left out if
+        ``skip_unknown``, the artifact has no embeddings to predict them.
+        """
+        # ml_lib is only needed for artifacts with a product table
+        from pv_rec.ml_lib import ProductShelf
+
+        shelf=ProductShelf()
+        shelf.product_labels=self.product_labels
+        return shelf.append_to_df(company_data, None,
+                                  skip_unknown=skip_unknown
+                                  )
+
+    def recommend(self, company_data: pd.DataFrame,
+                  mapping_needed: bool=True,
+                  skip_unknown: bool=True):
+        """
+        Same as ``Recommender.recommend``. If the artifact has a product
+        table and the companies are not labeled yet, their
+        ``product_categories`` are labeled first, see ``label_products``
+        for ``skip_unknown``.
+        """
+        if self.product_labels is not None and \
+                "product_categories" in company_data.columns and \
+                not company_data.columns.str.startswith(
+                    "product_label_").any():
+            company_data=self.label_products(company_data,
+                                             skip_unknown=skip_unknown
+                                             )
+
+        new_company=prepare_companies(company_data,
+                                      columns=self.columns,
+                                      ordinal_maps=self.ordinal_maps,
+                                      mapping_needed=mapping_needed
+                                      )
+        closest_cluster, pv_affinity=self.scorer.score(
+            self.transform(new_company)
+            )
+        new_company['labels']=closest_cluster
+
+        pv_affinity=pd.DataFrame(pv_affinity, index=new_company.index,
+                                 columns=['pv_affinity']
+                                 )
+        return pv_affinity, new_company
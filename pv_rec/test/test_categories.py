@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pv_rec import categories
+
+
+class TestParseProductCategories:
+    def test_parse_product_categories(self):
+        values = pd.Series(["{'Solartechnik', 'Baumaschinen'}", 'set()',
+                            np.nan, "{\"Bürger's Solar\", 'Solartechnik'}",
+                            "['Heizungstechnik', 'Heizungstechnik']",
+                            "{'C:\\\\Solar'}"],
+                           index=list('abcdef'), name='product_categories')
+
+        obj_ut = categories.parse_product_categories(values)
+
+        assert obj_ut.dtype == categories.ProductCategoriesDtype()
+        assert obj_ut.index.equals(values.index)
+        assert obj_ut['a'] == {'Solartechnik', 'Baumaschinen'}
+        assert obj_ut['b'] == set()
+        assert obj_ut.isna().tolist() == [False, False, True, False, False,
+                                          False]
+        assert obj_ut['d'] == {"Bürger's Solar", 'Solartechnik'}
+        assert obj_ut['e'] == {'Heizungstechnik'}
+        assert obj_ut['f'] == {'C:\\Solar'}
+        assert list(obj_ut.values.vocabulary).count('Solartechnik') == 1
+
+    def test_parse_repeated_items(self):
+        values = pd.Series(["{'a', 'a', 'b'}", "{'a', \"a\"}"])
+
+        obj_ut = categories.parse_product_categories(values)
+
+        assert obj_ut.values.lengths.tolist() == [2, 1]
+        assert obj_ut[0] == {'a', 'b'}
+
+    def test_parse_to_csv_round_trip(self, tmp_path):
+        data = pd.DataFrame({'product_categories': [
+            "{'Solartechnik', 'Baumaschinen'}", 'set()', np.nan
+        ]})
+        data['product_categories'] = \
+            categories.parse_product_categories(data.product_categories)
+        data.to_csv(tmp_path / 'data.csv')
+
+        obj_ut = categories.parse_product_categories(
+            pd.read_csv(tmp_path / 'data.csv').product_categories
+        )
+
+        assert obj_ut.tolist()[:2] == data.product_categories.tolist()[:2]
+        assert obj_ut.isna().tolist() == [False, False, True]
+
+
+class TestProductCategoriesArray:
+    @pytest.fixture
+    def categories_obj(self):
+        return categories.ProductCategoriesArray.from_sets(
+            [{'a', 'b'}, np.nan, set(), {'b', 'c'}]
+        )
+
+    def test_take(self, categories_obj):
+        obj_ut = categories_obj.take([3, -1, 0], allow_fill=True)
+
+        assert list(obj_ut.isna()) == [False, True, False]
+        assert obj_ut[0] == {'b', 'c'}
+        assert obj_ut[2] == {'a', 'b'}
+        assert obj_ut.vocabulary is categories_obj.vocabulary
+
+    def test_concat(self, categories_obj):
+        other = categories.ProductCategoriesArray.from_sets([{'d', 'a'}])
+
+        obj_ut = pd.concat([pd.Series(categories_obj), pd.Series(other)],
+                           ignore_index=True)
+
+        assert obj_ut.dtype == categories.ProductCategoriesDtype()
+        assert obj_ut[4] == {'a', 'd'}
+        assert obj_ut[3] == {'b', 'c'}
+
+    def test_setitem(self, categories_obj):
+        categories_obj[[0, 1]] = [{'d'}, np.nan]
+        categories_obj[3] = frozenset({'a', 'e'})
+
+        assert list(categories_obj.isna()) == [False, True, False, False]
+        assert categories_obj[0] == {'d'}
+        assert categories_obj[2] == set()
+        assert categories_obj[3] == {'a', 'e'}
+        with pytest.raises(TypeError):
+            categories_obj[0] = 0
+
+    def test_fillna(self, categories_obj):
+        obj_ut = pd.Series(categories_obj).fillna(
+            pd.Series([{'x'}] * 4)
+        )
+
+        assert obj_ut.dtype == categories.ProductCategoriesDtype()
+        assert obj_ut[1] == {'x'}
+        assert obj_ut[0] == {'a', 'b'}
+        assert categories_obj.isna()[1]
+
+    def test_explode(self, categories_obj):
+        obj_ut = pd.Series(categories_obj).explode()
+
+        assert obj_ut.index.tolist() == [0, 0, 1, 2, 3, 3]
+        assert set(obj_ut.dropna()) == {'a', 'b', 'c'}
+        assert obj_ut.isna().sum() == 2
+
+    def test_groupby_first(self, categories_obj):
+        data = pd.Series(categories_obj, index=['x', 'y', 'y', 'x'])
+
+        obj_ut = data.groupby(level=0).first()
+
+        assert obj_ut['x'] == {'a', 'b'}
+        assert obj_ut['y'] == set()
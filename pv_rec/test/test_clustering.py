@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from scipy.cluster.hierarchy import fcluster, linkage
+
+from pv_rec import clustering
+
+
+class TestWardLinkage:
+    @pytest.fixture
+    def features(self):
+        return np.random.default_rng(42).normal(size=(50, 4))
+
+    def test_ward_linkage_matches_scipy(self, features):
+        expected = linkage(features, method='ward', metric='euclidean')
+
+        obj_ut = clustering.ward_linkage(features)
+
+        assert np.allclose(obj_ut, expected)
+
+    def test_ward_linkage_fcluster(self, features):
+        expected = fcluster(linkage(features, method='ward'),
+                            t=3, criterion='maxclust'
+                            )
+
+        obj_ut = fcluster(clustering.ward_linkage(features),
+                          t=3, criterion='maxclust'
+                          )
+
+        assert (obj_ut == expected).all()
+
+    def test_ward_linkage_sample_weight(self):
+        features = np.array([[0.0], [1.0], [10.0]])
+
+        obj_ut = clustering.ward_linkage(features,
+                                         sample_weight=[1, 3, 2]
+                                         )
+
+        assert list(obj_ut[:, 3]) == [2, 3]
+        assert np.isclose(obj_ut[0, 2], np.sqrt(2 * 3 / 4))
+
+
+class TestMicroCluster:
+    def test_micro_cluster(self):
+        features = np.concatenate([np.zeros((10, 2)), np.ones((5, 2))])
+
+        labels, centroids, weights = clustering.micro_cluster(
+            features, n_clusters=2, random_state=42
+        )
+
+        assert sorted(weights) == [5, 10]
+        assert np.allclose(centroids[labels], features)
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pv_rec import data_cache
+
+
+class TestFrameArrays:
+    @pytest.fixture
+    def company_data(self):
+        return pd.DataFrame(
+            {'distribution_area': ['Lokal', np.nan, 'Regional'],
+             'founding_year': [1990, 0, 2001],
+             'installed_power': [1.5, np.nan, 0.0],
+             'is_producer': np.array([True, False, True], dtype=object),
+             'product_categories': [{'Solartechnik', 'Baumaschinen'},
+                                    set(),
+                                    {'Solartechnik'}]},
+            index=pd.Index(['company_a', 'company_b', 'company_c'],
+                           name='company_name')
+        )
+
+    def test_round_trip(self, company_data):
+        arrays, schema = data_cache.frame_to_arrays(company_data)
+
+        obj_ut = data_cache.arrays_to_frame(arrays, schema)
+
+        pd.testing.assert_frame_equal(obj_ut, company_data)
+        assert arrays['column_4_codes'].dtype == np.int32
+        assert list(arrays['column_4_offsets']) == [0, 2, 2, 3]
+
+    def test_mixed_column(self, company_data):
+        company_data['distribution_area'] = ['Lokal', 1, 'Regional']
+
+        with pytest.raises(TypeError):
+            data_cache.frame_to_arrays(company_data)
+
+
+class TestPreprocessedDataCache:
+    def test_load_and_save(self, tmp_path):
+        data = pd.DataFrame({'feature_a': ['a', 'b']}, index=['x', 'y'])
+        obj_ut = data_cache.PreprocessedDataCache(str(tmp_path))
+
+        assert obj_ut.load('key') is None
+        obj_ut.save('key', {'data': data})
+        pd.testing.assert_frame_equal(obj_ut.load('key')['data'], data)
+
+    def test_hash_files(self, tmp_path):
+        filepath = tmp_path / 'data.csv'
+        filepath.write_text('a,b\n1,2\n')
+        key = data_cache.hash_files([filepath], version=1)
+
+        assert data_cache.hash_files([filepath], version=1) == key
+        assert data_cache.hash_files([filepath], version=2) != key
+        filepath.write_text('a,b\n1,3\n')
+        assert data_cache.hash_files([filepath], version=1) != key
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pv_rec import data_classes
+from pv_rec.categories import ProductCategoriesDtype
+
+
+class TestParseWlwData:
+    @pytest.fixture
+    def raw_data(self):
+        return pd.DataFrame(
+            {"company_city": ["Berlin", "Köln"],
+             "distribution-area": ["national", "regional"],
+             "founding-year": [1990.0, 2005.0],
+             "employee-count": ["1-5", "6-10"],
+             "product_categories": ["{'Solartechnik'}", "set()"],
+             "Hersteller/Fabrikant": [True, False],
+             "Dienstleister": [False, False],
+             "Großhändler": [False, True],
+             "Lieferant": [True, True],
+             "Anzahl Module": [10.0, 0.0],
+             "Leistung": [3.5, 0.0],
+             },
+            index=pd.Index(["a", "b"], name="company_name")
+            )
+
+    def test_parse_wlw_data(self, raw_data):
+        obj_ut = data_classes.parse_wlw_data(raw_data)
+
+        assert list(obj_ut.columns) == [
+            ifield.name
+            for ifield in data_classes.fields(data_classes.DataclassWlwData)
+            ]
+        assert obj_ut.index.equals(raw_data.index)
+        assert obj_ut.founding_year.tolist() == [1990, 2005]
+        assert obj_ut.product_categories.dtype == ProductCategoriesDtype()
+        assert obj_ut.product_categories["b"] == set()
+        assert obj_ut.is_wholesales.tolist() == [False, True]
+        # columns without a parse function are not copied
+        assert np.shares_memory(obj_ut.installed_power.values,
+                                raw_data["Leistung"].values)
+
+    def test_parse_wlw_data_parsed_categories(self, raw_data):
+        parsed_data = data_classes.parse_wlw_data(raw_data)
+        raw_data["product_categories"] = parsed_data.product_categories
+
+        obj_ut = data_classes.parse_wlw_data(raw_data)
+
+        assert obj_ut.product_categories.dtype == ProductCategoriesDtype()
+        assert obj_ut.product_categories.tolist() == \
+            parsed_data.product_categories.tolist()
+
+    def test_validate_schema_missing_columns(self, raw_data):
+        with pytest.raises(KeyError, match="Leistung.*Lieferant|"
+                                           "Lieferant.*Leistung"):
+            data_classes.validate_schema(
+                raw_data.drop(columns=["Leistung", "Lieferant"])
+                )
+
+    def test_validate_schema_wrong_dtype(self, raw_data):
+        raw_data["Leistung"] = ["3.5", "0"]
+
+        with pytest.raises(TypeError, match="Leistung"):
+            data_classes.validate_schema(raw_data)
+
+    def test_parse_wlw_data_castable_columns(self, raw_data):
+        raw_data["founding-year"] = ["1990", "2005"]
+        raw_data["Dienstleister"] = [0, 1]
+
+        obj_ut = data_classes.parse_wlw_data(raw_data)
+
+        assert obj_ut.founding_year.tolist() == [1990, 2005]
+        assert obj_ut.is_serviceprovider.tolist() == [0, 1]
+
+    def test_parse_wlw_data_invalid_values(self, raw_data):
+        raw_data["founding-year"] = ["1990", "unknown"]
+
+        with pytest.raises(ValueError, match="founding-year"):
+            data_classes.parse_wlw_data(raw_data)
@@ -3,7 +3,7 @@ from unittest import mock
 import pandas as pd
 import pytest
 
-from utils import data_factory as factory
+from pv_rec import data_factory as factory
 
 
 class TestWlwPipeline:
@@ -40,9 +40,78 @@ class TestWlwPipeline:
     def test_encode_products(self, wlw_pipeline_obj):
         wlw_pipeline_obj.transform()
         with mock.patch(
-                'utils.ml_lib.AbstractProductEncoder.embedd_it_parallel',
+                'pv_rec.ml_lib.AbstractProductEncoder.embedd_it_parallel',
                 return_value=True):
             obj_ut = wlw_pipeline_obj.encode_products(
                 n_jobs=-1,
                 n_chunks=2)
         assert obj_ut
+
+
+class TestDataMasterSolar:
+    @pytest.fixture
+    def solar_data(self):
+        return pd.DataFrame(
+            {'MODANETTO': ['12.0', 'no close roof found', float('nan'),
+                           '3'],
+             'KW_19_5': ['4.5', 'more than 1 roof object found', '1',
+                         float('nan')]},
+            index=['a', 'b', 'c', 'd']
+        )
+
+    def test_clean_solar_data(self, solar_data):
+        factory.DataMaster.clean_solar_data(solar_data)
+
+        assert list(solar_data.columns) == ['Anzahl Module', 'Leistung']
+        assert solar_data['Anzahl Module'].dtype == 'int64'
+        assert list(solar_data['Anzahl Module']) == [12, 0, 0, 3]
+        pd.testing.assert_series_equal(
+            solar_data['Leistung'],
+            pd.Series([4.5, 0.0, 1.0, float('nan')],
+                      index=['a', 'b', 'c', 'd'], name='Leistung')
+        )
+
+    def test_clean_solar_data_invalid_count(self, solar_data):
+        solar_data.loc['d', 'MODANETTO'] = '2.5'
+
+        with pytest.raises(ValueError):
+            factory.DataMaster.clean_solar_data(solar_data)
+
+
+class TestDataMasterMastr:
+    @pytest.fixture
+    def mastr_filepath(self, tmp_path):
+        mastr_data = pd.DataFrame(
+            {'company_name': ['a', 'b', 'a', 'c', 'a'],
+             'company_street': ['Str 1'] * 5,
+             'company_zip': [31134.0] * 5,
+             'company_city': ['Hildesheim'] * 5,
+             'distribution-area': ['Lokal', 'Regional', 'Weltweit', None,
+                                   'Lokal'],
+             'founding-year': [1990.0, None, 1980.0, 2000.0, 1995.0],
+             'employee-count': ['1-4', '5-9', None, '1-4', '10-19'],
+             'Hersteller/Fabrikant': [True, None, False, True, None],
+             'Dienstleister': [None, True, None, None, True],
+             'Großhändler': [False, None, None, None, None],
+             'Lieferant': [None, None, True, None, None],
+             'product_categories': ["{'Solartechnik'}", "{'Baumaschinen'}",
+                                    "{'Heizungstechnik'}", "{'Solartechnik'}",
+                                    "{'Solarmodule'}"],
+             'Anzahl Module': [10.0, None, 20.0, 5.0, None],
+             'Leistung': [1.0, 2.0, None, 4.0, 3.0]},
+            index=['a', 'b', 'a', 'c', 'a']
+        )
+        filepath = tmp_path / 'mastr.csv'
+        mastr_data.to_csv(filepath)
+        return filepath
+
+    def test_load_mastr_data_chunked(self, mastr_filepath):
+        expected = factory.DataMaster.load_mastr_data(mastr_filepath)
+
+        obj_ut = factory.DataMaster.load_mastr_data(mastr_filepath,
+                                                    chunksize=2)
+
+        pd.testing.assert_frame_equal(obj_ut, expected, check_dtype=False)
+        assert obj_ut.is_producer.dtype == bool
+        assert obj_ut.loc['a', 'num_modules'] == 15
+        assert obj_ut.loc['a', 'product_categories'] == {'Solartechnik'}
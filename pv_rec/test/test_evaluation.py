@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pv_rec import evaluation
+
+
+class TestThresholdMetrics:
+    def test_threshold_metrics(self):
+        pv_affinity = np.array([0.9, 0.6, 0.2, 0.7, 0.1])
+        is_positive = np.array([True, True, True, False, False])
+
+        obj_ut = evaluation.threshold_metrics(pv_affinity, is_positive,
+                                              [0.0, 0.6, 0.8, 1.0]
+                                              )
+
+        np.testing.assert_array_equal(obj_ut.true_positives, [3, 2, 1, 0])
+        np.testing.assert_array_equal(obj_ut.false_positives, [2, 1, 0, 0])
+        np.testing.assert_allclose(obj_ut.recall, [1, 2 / 3, 1 / 3, 0])
+        np.testing.assert_allclose(obj_ut.miss_rate, [0, 1 / 3, 2 / 3, 1])
+        np.testing.assert_allclose(obj_ut.precision,
+                                   [3 / 5, 2 / 3, 1, np.nan]
+                                   )
+
+
+class TestSplits:
+    @pytest.fixture
+    def company_data(self):
+        rng = np.random.default_rng(0)
+        mastr_data = pd.DataFrame(
+            {'feature_a': rng.random(60) + 0.5,
+             'feature_b': rng.random(60),
+             'stratum': np.repeat(['a', 'b'], 30)},
+            index=[f'mastr_{i}' for i in range(60)]
+        )
+        wlw_data = pd.DataFrame(
+            {'feature_a': rng.random(80),
+             'feature_b': rng.random(80),
+             'stratum': np.repeat(['a', 'b'], 40)},
+            index=[f'wlw_{i}' for i in range(80)]
+        )
+        return mastr_data, wlw_data
+
+    def test_make_splits(self, company_data):
+        mastr_data, wlw_data = company_data
+
+        obj_ut = evaluation.make_splits(mastr_data, wlw_data, n_splits=3,
+                                        test_size=10, wlw_test_size=0,
+                                        stratify='stratum'
+                                        )
+
+        assert len(obj_ut) == 3
+        for mastr_holdout, wlw_holdout in obj_ut:
+            assert len(mastr_holdout) == 10
+            assert len(wlw_holdout) == 0
+            assert (mastr_data.stratum.iloc[mastr_holdout] == 'a').sum() == 5
+
+    def test_evaluate_recommender(self, company_data):
+        mastr_data, wlw_data = company_data
+
+        summary, split_metrics = evaluation.evaluate_recommender(
+            mastr_data.drop(columns='stratum'),
+            wlw_data.drop(columns='stratum'),
+            n_splits=3, test_size=10, thresholds=[0.0, 0.5],
+            cut_line=0.5, mapping_needed=False, n_jobs=1
+        )
+
+        assert split_metrics.index.names == ['split', 'threshold']
+        assert len(split_metrics) == 6
+        assert (summary[('recall', 'mean')].loc[0.0] == 1)
+        assert (summary[('recall', 'ci_low')]
+                <= summary[('recall', 'mean')]).all()
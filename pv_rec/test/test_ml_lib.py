@@ -3,17 +3,14 @@ import random
 import shutil
 from unittest import mock
 
+import numpy as np
 import pandas as pd
 import pytest
-from more_itertools.more import side_effect
-from sentence_transformers import SentenceTransformer
-from sklearn.cluster import KMeans
-from transformers.models.cvt\
-    .convert_cvt_original_pytorch_checkpoint_to_pytorch import \
-    embeddings
+from sklearn.cluster import KMeans, MiniBatchKMeans
 
-import utils.data_factory
-from utils import ml_lib
+import pv_rec.data_factory
+from pv_rec import ml_lib
+from pv_rec.categories import ProductCategoriesArray
 
 random.seed(42)
 
@@ -27,7 +24,7 @@ class TestProductShelf:
 
     @pytest.fixture
     def product_shelf_obj(self, prod_embeddings):
-        return utils.ml_lib.ProductShelf(prod_embeddings,
+        return pv_rec.ml_lib.ProductShelf(prod_embeddings,
                                          clustering=KMeans(n_clusters=3)
                                          )
 
@@ -47,7 +44,7 @@ class TestProductShelf:
             r"data/test_data_factory/wlw_test_data.csv",
             index_col=0
         )
-        wlw_pipeline = utils.data_factory.WlwPipeline(data)
+        wlw_pipeline = pv_rec.data_factory.WlwPipeline(data)
         wlw_pipeline.transform()
 
         product_shelf_obj.fit()
@@ -122,20 +119,54 @@ class TestAbstractProductEncoder:
 
         assert exception_info.typename == "ExecError"
 
-    def test_embedd_it_parallel(self, abstract_product_encoder_obj,
-                                requests_mock
-                                ):
-        with requests_mock, \
-                mock.patch('utils.ml_lib.AbstractProductEncoder'
-                           '._post_process_results', return_value=42
-                           ):
-            embeddings = \
-                abstract_product_encoder_obj.embedd_it_parallel(
-                    n_jobs=1,
-                    n_chunks=2
-                )
-
-        assert embeddings == 42
+    def test_embedd_it_parallel(self, abstract_product_encoder_obj):
+        abstract_product_encoder_obj.products = [
+            'a', 'bb', 'a', 'cccc', 'ddddd', 'eeeeee'
+        ]
+        abstract_product_encoder_obj.batch_size = 2
+        abstract_product_encoder_obj.max_seq_length = 128
+        model_mock = mock.MagicMock()
+        model_mock.encode.side_effect = lambda texts, **kwargs: np.array(
+            [[len(itext), 0.0] for itext in texts]
+        )
+
+        def init_worker_mock(*args):
+            ml_lib._worker_model = model_mock
+
+        class InProcessPool:
+            def __init__(self, initializer, initargs, **kwargs):
+                initializer(*initargs)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                ml_lib._worker_model = None
+
+            def map(self, function, iterable):
+                return map(function, iterable)
+
+        with mock.patch('pv_rec.ml_lib._init_embedding_worker',
+                        side_effect=init_worker_mock) as init_mock, \
+                mock.patch('pv_rec.ml_lib.ProcessPoolExecutor',
+                           InProcessPool):
+            embeddings = abstract_product_encoder_obj.embedd_it_parallel(
+                n_jobs=2,
+                n_chunks=3
+            )
+
+        assert list(embeddings.index) == ['a', 'bb', 'cccc', 'ddddd',
+                                          'eeeeee']
+        assert list(embeddings[0]) == [1, 2, 4, 5, 6]
+        assert model_mock.encode.call_count == 3
+        assert all(icall.kwargs['batch_size'] == 2 for icall in
+                   model_mock.encode.call_args_list)
+        assert init_mock.call_args.args[3] == 128
+
+    def test_embedd_it_parallel_rejects_zero_jobs(
+            self, abstract_product_encoder_obj):
+        with pytest.raises(ValueError):
+            abstract_product_encoder_obj.embedd_it_parallel(n_jobs=0)
 
     def test__join_results(self, abstract_product_encoder_obj):
         result1 = [1, 2, 3]
@@ -159,3 +190,458 @@ class TestAbstractProductEncoder:
             )
 
         assert (obj_ut == expected).all().all()
+
+
+class TestEmbeddingCache:
+    @pytest.fixture
+    def cached_encoder_obj(self, tmp_path):
+        return ml_lib.AbstractProductEncoder(products=['some Product1'],
+                                             model_name='random_model',
+                                             cache_dir=str(tmp_path)
+                                             )
+
+    def test_embedd_it_local_uses_cache(self, cached_encoder_obj, tmp_path):
+        encode_mock = mock.MagicMock(
+            side_effect=lambda texts: np.ones((len(texts), 3))
+        )
+        with mock.patch.object(cached_encoder_obj, '_encode', encode_mock):
+            cached_encoder_obj.embedd_it_local(['Apfel', 'Birne'])
+
+        warm_encoder = ml_lib.AbstractProductEncoder(
+            products=['some Product1'],
+            model_name='random_model',
+            cache_dir=str(tmp_path)
+        )
+        with mock.patch.object(warm_encoder, '_encode', encode_mock):
+            embeddings = warm_encoder.embedd_it_local(['Birne', ' Apfel'])
+
+        assert encode_mock.call_count == 1
+        assert embeddings.shape == (2, 3)
+        assert list(embeddings.index) == ['Birne', ' Apfel']
+
+    def test_missing(self, cached_encoder_obj):
+        cached_encoder_obj.cache.add(['Apfel'], np.ones((1, 3)))
+
+        obj_ut = cached_encoder_obj.cache.missing(['Apfel', 'Birne', 'Birne'])
+
+        assert obj_ut == ['Birne']
+
+    def test_model_settings_separate_caches(self, cached_encoder_obj,
+                                            tmp_path):
+        cached_encoder_obj.cache.add(['Apfel'], np.ones((1, 3)))
+
+        quantized_encoder = ml_lib.AbstractProductEncoder(
+            products=['some Product1'],
+            model_name='random_model',
+            cache_dir=str(tmp_path),
+            quantize_model=True,
+            max_seq_length=128
+        )
+
+        assert quantized_encoder.cache.missing(['Apfel']) == ['Apfel']
+        assert quantized_encoder.cache.cache_dir != \
+            cached_encoder_obj.cache.cache_dir
+
+    def test_add_after_orphan_rows(self, cached_encoder_obj, tmp_path):
+        cache = cached_encoder_obj.cache
+        cache.add(['a'], np.zeros((1, 2)))
+        # a run that died after writing its vectors but before the index
+        with open(cache._path(cache.vector_file), 'ab') as file:
+            file.write(np.full((1, 2), 9, dtype=np.float32).tobytes())
+
+        obj_ut = ml_lib.EmbeddingCache(str(tmp_path), 'random_model')
+        obj_ut.add(['b'], np.ones((1, 2)))
+
+        assert obj_ut.get(['a', 'b']).tolist() == [[0, 0], [1, 1]]
+        assert ml_lib.EmbeddingCache(str(tmp_path), 'random_model') \
+            .get(['b']).tolist() == [[1, 1]]
+
+    def test_index_behind_vector_file(self, cached_encoder_obj, tmp_path):
+        cache = cached_encoder_obj.cache
+        cache.add(['a', 'b'], np.ones((2, 2)))
+        with open(cache._path(cache.vector_file), 'r+b') as file:
+            file.truncate(cache._row_bytes())
+
+        obj_ut = ml_lib.EmbeddingCache(str(tmp_path), 'random_model')
+
+        assert obj_ut.missing(['a', 'b']) == ['b']
+
+
+class TestLengthBucketing:
+    @pytest.fixture
+    def model_mock(self):
+        model = mock.MagicMock(max_seq_length=512)
+        model.tokenizer.side_effect = lambda texts, **kwargs: {
+            'input_ids': [[0] * len(itext.split()) for itext in texts]
+        }
+        model.encode.side_effect = lambda texts, **kwargs: np.array(
+            [[len(itext.split())] for itext in texts], dtype=float
+        )
+        return model
+
+    def test_encode_bucketed_restores_order(self, model_mock):
+        texts = ['a b c', 'a', 'a b c d', 'a b']
+        encoder = ml_lib.AbstractProductEncoder(products=texts,
+                                                model_name='random_model',
+                                                batch_size=2,
+                                                length_bucketing=True
+                                                )
+        with mock.patch.object(encoder, '_load_model',
+                               return_value=model_mock):
+            embeddings = encoder.embedd_it_local(texts)
+
+        assert list(embeddings[0]) == [3, 1, 4, 2]
+        assert [len(icall.args[0]) for icall in
+                model_mock.encode.call_args_list] == [2, 2]
+
+
+class TestQuantizedEmbeddings:
+    def test_from_embeddings(self):
+        embeddings = np.array([[1.0, -0.5], [-2.0, 0.25], [0.5, 0.0]])
+
+        obj_ut = ml_lib.QuantizedEmbeddings.from_embeddings(
+            embeddings, index=['a', 'b', 'c']
+        )
+
+        assert obj_ut.codes.dtype == np.int8
+        assert np.allclose(obj_ut.to_frame().values, embeddings, atol=0.01)
+        assert list(obj_ut.lookup(['c', 'a']).index) == ['c', 'a']
+
+    def test_lookup_duplicated_index(self):
+        embeddings = np.array([[1.0], [2.0], [3.0], [4.0]])
+        obj_ut = ml_lib.QuantizedEmbeddings.from_embeddings(
+            embeddings, index=['x', 'y', 'x', 'y']
+        )
+
+        looked_up = obj_ut.lookup(['y', 'x'])
+
+        assert np.allclose(looked_up.values, [[2.0], [1.0]], atol=0.05)
+        with pytest.raises(KeyError):
+            obj_ut.lookup(['z'])
+
+    def test_invalid_embedding_dtype(self):
+        with pytest.raises(ValueError):
+            ml_lib.AbstractProductEncoder(products=['some Product1'],
+                                          model_name='random_model',
+                                          embedding_dtype='int4'
+                                          )
+
+
+class TestWlwProductEncoderTable:
+    def test_embed_new(self):
+        encoder = ml_lib.WlwProductEncoder(
+            products=pd.Series([{'Apfel', 'Birne'}, {'Birne'}]),
+            model_name='random_model'
+        )
+        encode_mock = mock.MagicMock(
+            side_effect=lambda texts: np.ones((len(texts), 3))
+        )
+        with mock.patch.object(encoder, '_encode', encode_mock):
+            encoder.embedd_it_local(encoder.products)
+            obj_ut = encoder.embed_new(
+                pd.Series([{'Apfel', 'Banane'}, {'Banane'}])
+            )
+
+        assert encode_mock.call_args.args[0] == ['Banane']
+        assert sorted(obj_ut.index) == ['Apfel', 'Banane', 'Birne']
+
+    def test_embed_new_keeps_buffer(self):
+        encoder = ml_lib.WlwProductEncoder(
+            products=pd.Series([{'Apfel', 'Birne'}, {'Birne'}]),
+            model_name='random_model'
+        )
+        encode_mock = mock.MagicMock(
+            side_effect=lambda texts: np.ones((len(texts), 3))
+        )
+        with mock.patch.object(encoder, '_encode', encode_mock):
+            encoder.embedd_it_local(encoder.products)
+            buffer = encoder._table_buffer
+            encoder.embed_new(['Banane', 'Kirsche'])
+
+        assert encoder._table_buffer is buffer
+        assert encoder.embeddings.shape == (4, 3)
+
+    def test_embedd_it_parallel_fills_table(self):
+        encoder = ml_lib.WlwProductEncoder(
+            products=pd.Series([{'Apfel', 'Birne'}, {'Birne'}]),
+            model_name='random_model'
+        )
+        with mock.patch.object(
+                encoder, '_embedd_chunks_parallel',
+                side_effect=lambda texts, **kwargs: pd.DataFrame(
+                    np.ones((len(texts), 3)), index=texts)
+        ), mock.patch.object(encoder, '_encode') as encode_mock:
+            encoder.embedd_it_parallel(n_jobs=1)
+            obj_ut = encoder.embed_new(pd.Series([{'Apfel'}, {'Birne'}]))
+
+        encode_mock.assert_not_called()
+        assert sorted(obj_ut.index) == ['Apfel', 'Birne']
+
+
+class TestProductShelfAppendToDf:
+    def test_append_to_df_counts_labels(self):
+        data = pd.DataFrame(
+            {'product_categories': [{'Apfel', 'Birne'}, set(),
+                                    {'Birne', 'Banane', 'Kirsche'}]},
+            index=['company_a', 'company_b', 'company_c']
+        )
+        product_labels = {'Apfel': 1, 'Birne': 0, 'Banane': 1, 'Kirsche': 1}
+        shelf = ml_lib.ProductShelf(clustering=KMeans(n_clusters=2))
+
+        with mock.patch.object(
+                shelf, 'get_product_labels',
+                side_effect=lambda products, embeddings, **kwargs: np.array(
+                    [product_labels[iproduct] for iproduct in products])
+        ):
+            obj_ut = shelf.append_to_df(data, embeddings=None)
+
+        assert list(obj_ut.columns) == ['product_categories',
+                                        'product_label_0',
+                                        'product_label_1']
+        assert list(obj_ut.product_label_1.fillna(-1)) == [1, -1, 2]
+        assert list(obj_ut.product_label_0.fillna(-1)) == [1, -1, 1]
+
+    def test_append_to_df_product_categories_array(self):
+        product_categories = ProductCategoriesArray.from_sets(
+            [{'Apfel', 'Birne'}, {'Bagger'}, np.nan, {'Birne', 'Banane'}]
+        )
+        data = pd.DataFrame({'product_categories': product_categories},
+                            index=['company_a', 'company_b', 'company_c',
+                                   'company_d']
+                            ).iloc[[0, 2, 3]]
+        product_labels = {'Apfel': 1, 'Birne': 0, 'Banane': 1}
+        shelf = ml_lib.ProductShelf(clustering=KMeans(n_clusters=2))
+        shelf.product_labels = product_labels
+
+        obj_ut = shelf.append_to_df(data)
+
+        expected = shelf.append_to_df(
+            data.assign(product_categories=[{'Apfel', 'Birne'}, np.nan,
+                                            {'Birne', 'Banane'}])
+        )
+        pd.testing.assert_frame_equal(
+            obj_ut.drop(columns='product_categories'),
+            expected.drop(columns='product_categories')
+        )
+        assert list(obj_ut.product_label_1.fillna(-1)) == [1, -1, 1]
+
+
+class TestProductShelfLookup:
+    @pytest.fixture
+    def fitted_shelf_obj(self):
+        embeddings = pd.DataFrame([[0.0, 0.1], [0.1, 0.0], [5.0, 5.1]],
+                                  index=['Apfel', 'Birne', 'Bagger']
+                                  )
+        shelf = ml_lib.ProductShelf(clustering=KMeans(n_clusters=2,
+                                                      random_state=42
+                                                      )
+                                    )
+        shelf.fit(embeddings)
+        return shelf
+
+    def test_get_product_labels_without_embeddings(self, fitted_shelf_obj):
+        with mock.patch('sklearn.pipeline.Pipeline.predict') as predict_mock:
+            obj_ut = fitted_shelf_obj.get_product_labels(['Apfel', 'Bagger'])
+
+        predict_mock.assert_not_called()
+        assert obj_ut[0] != obj_ut[1]
+
+    def test_save_product_labels(self, fitted_shelf_obj, tmp_path):
+        filepath = tmp_path / 'product_labels.npz'
+        fitted_shelf_obj.save_product_labels(filepath)
+
+        obj_ut = ml_lib.ProductShelf.from_product_labels(filepath)
+
+        assert obj_ut.product_labels == fitted_shelf_obj.product_labels
+
+    def test_unknown_product(self, fitted_shelf_obj):
+        with pytest.raises(KeyError):
+            fitted_shelf_obj.get_product_labels(['Kirsche'])
+
+
+class TestProductShelfStreaming:
+    def test_fit_streaming(self):
+        embeddings = pd.DataFrame(
+            [[0.0, 0.1], [5.0, 5.1], [0.1, 0.0], [5.1, 5.0]] * 25,
+            index=[f'product_{i}' for i in range(100)]
+        )
+        shelf = ml_lib.ProductShelf(clustering=MiniBatchKMeans(n_clusters=2,
+                                                               random_state=42
+                                                               )
+                                    )
+
+        shelf.fit_streaming(embeddings, chunk_size=10, sample_size=20)
+
+        labels = shelf.get_product_labels(['product_0', 'product_1',
+                                           'product_2'])
+        assert len(shelf.product_labels) == 100
+        assert labels[0] == labels[2] != labels[1]
+
+    def test_fit_streaming_list_of_chunks(self):
+        embeddings = pd.DataFrame(
+            [[0.0, 0.1], [5.0, 5.1], [0.1, 0.0], [5.1, 5.0]] * 5,
+            index=[f'product_{i}' for i in range(20)]
+        )
+        shelf = ml_lib.ProductShelf(clustering=MiniBatchKMeans(n_clusters=2,
+                                                               random_state=42
+                                                               )
+                                    )
+
+        shelf.fit_streaming([embeddings.iloc[:10], embeddings.iloc[10:]])
+
+        assert len(shelf.product_labels) == 20
+
+    def test_fit_streaming_rejects_generator(self):
+        embeddings = np.zeros((10, 2))
+        shelf = ml_lib.ProductShelf(clustering=MiniBatchKMeans(n_clusters=2))
+
+        with pytest.raises(TypeError, match='function'):
+            shelf.fit_streaming(ichunk for ichunk in [embeddings])
+
+    def test_fit_streaming_needs_partial_fit(self):
+        shelf = ml_lib.ProductShelf(clustering=KMeans(n_clusters=2))
+
+        with pytest.raises(ValueError):
+            shelf.fit_streaming(np.zeros((10, 2)))
+
+
+class TestStaticVocabularyEncoder:
+    @pytest.fixture
+    def vocabulary_filepath(self, tmp_path):
+        filepath = tmp_path / 'vocabulary.npz'
+        ml_lib.StaticVocabularyEncoder.save_vocabulary(
+            filepath,
+            pd.DataFrame([[1.0, 2.0], [3.0, 4.0]], index=['Apfel', 'Birne']),
+            model_name='random_model',
+            dtype='float16'
+        )
+        return filepath
+
+    def test_embedd_it_local_skips_unknown(self, vocabulary_filepath):
+        encoder = ml_lib.StaticVocabularyEncoder(
+            products=['Birne', 'Banane'],
+            vocabulary_filepath=vocabulary_filepath
+        )
+        with mock.patch.object(encoder, '_encode') as encode_mock:
+            obj_ut = encoder.embedd_it_local(encoder.products)
+
+        encode_mock.assert_not_called()
+        assert encoder.model_name == 'random_model'
+        assert list(obj_ut.index) == ['Birne']
+        assert list(obj_ut.loc['Birne']) == [3.0, 4.0]
+
+    def test_append_to_df_skips_unknown(self, vocabulary_filepath):
+        data = pd.DataFrame({'product_categories': [{'Birne', 'Banane'},
+                                                    {'Banane'},
+                                                    {'Apfel'}]},
+                            index=['company_a', 'company_b', 'company_c']
+                            )
+        encoder = ml_lib.StaticVocabularyEncoder(
+            products=['Apfel', 'Birne', 'Banane'],
+            vocabulary_filepath=vocabulary_filepath
+        )
+        embeddings = encoder.embedd_it_local(encoder.products)
+        shelf = ml_lib.ProductShelf(clustering=KMeans(n_clusters=2,
+                                                      random_state=42
+                                                      )
+                                    )
+        shelf.fit(embeddings)
+
+        with pytest.raises(KeyError):
+            shelf.append_to_df(data, embeddings)
+        obj_ut = shelf.append_to_df(data, embeddings, skip_unknown=True)
+
+        label_counts = obj_ut.filter(like='product_label_')
+        assert list(label_counts.sum(axis=1)) == [1, 0, 1]
+        assert 'Banane' not in shelf.product_labels
+
+    def test_embedd_it_local_falls_back_to_model(self, vocabulary_filepath):
+        encoder = ml_lib.StaticVocabularyEncoder(
+            products=['Birne', 'Banane'],
+            vocabulary_filepath=vocabulary_filepath,
+            on_unknown='model'
+        )
+        with mock.patch.object(encoder, '_encode',
+                               return_value=np.array([[5.0, 6.0]])):
+            obj_ut = encoder.embedd_it_local(encoder.products)
+
+        assert list(obj_ut.loc['Banane']) == [5.0, 6.0]
+
+    def test_embedd_it_local_raises(self, vocabulary_filepath):
+        encoder = ml_lib.StaticVocabularyEncoder(
+            products=['Banane'],
+            vocabulary_filepath=vocabulary_filepath,
+            on_unknown='raise'
+        )
+        with pytest.raises(KeyError):
+            encoder.embedd_it_local(encoder.products)
+
+
+class TestCategoryBagEncoder:
+    @pytest.fixture
+    def product_categories(self):
+        return pd.Series([{'Solartechnik', 'Solarmodule'},
+                          {'Baumaschinen', 'Straßenbaumaschinen'},
+                          {'Solartechnik'}])
+
+    def test_embedd_it_local(self, product_categories):
+        encoder = ml_lib.CategoryBagEncoder(product_categories,
+                                            n_components=2,
+                                            random_state=42
+                                            )
+
+        obj_ut = encoder.embedd_it_local(encoder.products)
+
+        assert obj_ut.shape == (4, 2)
+        assert set(obj_ut.index) == {'Solartechnik', 'Solarmodule',
+                                     'Baumaschinen', 'Straßenbaumaschinen'}
+
+    def test_embedd_it_local_single_product(self):
+        encoder = ml_lib.CategoryBagEncoder(pd.Series([{'Solartechnik'}]),
+                                            n_components=8,
+                                            random_state=42
+                                            )
+
+        obj_ut = encoder.embedd_it_local(encoder.products)
+
+        assert obj_ut.shape == (1, 1)
+        assert encoder.n_components == 8
+
+    def test_embedd_it_parallel_in_process(self, product_categories):
+        encoder = ml_lib.CategoryBagEncoder(product_categories,
+                                            n_components=2,
+                                            random_state=42
+                                            )
+
+        with mock.patch('pv_rec.ml_lib.ProcessPoolExecutor') as pool_mock:
+            obj_ut = encoder.embedd_it_parallel(n_jobs=2)
+
+        pool_mock.assert_not_called()
+        assert obj_ut.shape == (4, 2)
+        assert encoder.embeddings.shape == (4, 2)
+
+    def test_int8_needs_n_components(self, product_categories):
+        with pytest.raises(ValueError):
+            ml_lib.CategoryBagEncoder(product_categories,
+                                      n_components=None,
+                                      embedding_dtype='int8'
+                                      )
+
+    def test_append_to_df_with_sparse_features(self, product_categories):
+        encoder = ml_lib.CategoryBagEncoder(product_categories,
+                                            n_features=2**10,
+                                            n_components=None
+                                            )
+        embeddings = encoder.embedd_it_local(encoder.products)
+        shelf = ml_lib.ProductShelf(clustering=KMeans(n_clusters=2,
+                                                      random_state=42
+                                                      )
+                                    )
+
+        shelf.fit(embeddings)
+        obj_ut = shelf.append_to_df(
+            pd.DataFrame({'product_categories': product_categories}),
+            embeddings
+        )
+
+        assert obj_ut.filter(like='product_label_').sum().sum() == 5
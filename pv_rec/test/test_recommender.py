@@ -0,0 +1,224 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.cluster.hierarchy import fcluster, linkage
+from sklearn.metrics import adjusted_rand_score
+
+from pv_rec import recommender
+from pv_rec.categories import parse_product_categories
+
+
+class TestRecommender:
+    @pytest.fixture
+    def recommender_obj(self):
+        return recommender.Recommender()
+
+    def test__calc_pv_affinity_scores(self, recommender_obj):
+        labels = np.array([3, 1, 3, 3, 2])
+        is_mastr = np.array([True, False, False, True, True])
+        expected = pd.DataFrame(
+            {'total_companies': [3.0, 1.0, 1.0],
+             'mastr_data': [2.0, 0.0, 1.0],
+             'percent': [2 / 3, 0.0, 1.0]},
+            index=['cluster_3', 'cluster_1', 'cluster_2']
+        )
+
+        obj_ut = recommender_obj._calc_pv_affinity_scores(labels, is_mastr)
+
+        pd.testing.assert_frame_equal(obj_ut, expected)
+
+    def test__prepare_low_memory(self, recommender_obj):
+        mastr_data = pd.DataFrame(
+            {'distribution_area': ['Lokal', 'Europa', None],
+             'employee_count': ['1-4', None, '10-19'],
+             'feature_a': [1.0, np.nan, 3.0],
+             'product_categories': [{'a'}, {'b'}, {'c'}]},
+            index=['c', 'a', 'e']
+        )
+        wlw_data = pd.DataFrame(
+            {'distribution_area': ['Regional', 'Weltweit'],
+             'employee_count': ['5-9', '1-4'],
+             'feature_a': [7.0, 8.0],
+             'feature_b': [1.0, np.nan],
+             'product_categories': [{'a'}, {'b'}]},
+            index=['a', 'b']
+        )
+        expected = recommender_obj._prepare_data(
+            wlw_data.copy(), mastr_data.copy(), mapping_needed=True
+        ).astype(np.float32)
+
+        obj_ut = recommender_obj._prepare_low_memory(
+            wlw_data, mastr_data, mapping_needed=True
+        )
+
+        pd.testing.assert_frame_equal(obj_ut, expected)
+        assert 'source' not in mastr_data.columns
+
+    def test__label_averages(self, recommender_obj):
+        scaled_ml = np.array([[0.0, 1.0], [1.0, 0.0], [0.5, 0.5], [1.0, 1.0]])
+        labels = np.array([2, 1, 2, 2])
+        expected = pd.DataFrame(
+            scaled_ml, columns=['feature_a', 'feature_b']
+        ).groupby(labels).mean().rename_axis('labels')
+
+        obj_ut = recommender_obj._label_averages(
+            scaled_ml, labels, pd.Index(['feature_a', 'feature_b'])
+        )
+
+        pd.testing.assert_frame_equal(obj_ut, expected)
+
+
+class TestRecommenderFitted:
+    @pytest.fixture
+    def company_data(self):
+        rng = np.random.default_rng(42)
+        mastr_data = pd.DataFrame(rng.random((40, 3)) + 0.5,
+                                  columns=['feature_a', 'feature_b',
+                                           'feature_c'],
+                                  index=[f'mastr_{i}' for i in range(40)]
+                                  )
+        wlw_data = pd.DataFrame(rng.random((60, 3)),
+                                columns=['feature_a', 'feature_b',
+                                         'feature_c'],
+                                index=[f'wlw_{i}' for i in range(60)]
+                                )
+        return mastr_data, wlw_data
+
+    @pytest.fixture
+    def fitted_recommender_obj(self, company_data):
+        mastr_data, wlw_data = company_data
+        obj = recommender.Recommender()
+        obj.cut_line = 0.5
+        obj.fit(wlw_data=wlw_data.copy(), mastr_data=mastr_data.copy(),
+                mapping_needed=False
+                )
+        return obj
+
+    def test_sweep_cut_lines(self, fitted_recommender_obj, company_data):
+        mastr_data, _ = company_data
+
+        obj_ut = fitted_recommender_obj.sweep_cut_lines(
+            heights=[0.5, 100], holdout_data=mastr_data.iloc[:10],
+            mapping_needed=False
+        )
+
+        assert obj_ut.loc[0.5, 'n_clusters'] == \
+            len(fitted_recommender_obj.pv_affinity_scores)
+        assert obj_ut.loc[100, 'n_clusters'] == 1
+        assert obj_ut.loc[100, 'recall'] == 0
+
+    def test_update(self, fitted_recommender_obj, company_data):
+        mastr_data, wlw_data = company_data
+        new_mastr = mastr_data.iloc[:5].rename(
+            index=lambda icompany: f'new_{icompany}'
+        )
+        total_before = \
+            fitted_recommender_obj.pv_affinity_scores.total_companies.sum()
+
+        drift = fitted_recommender_obj.update(new_mastr=new_mastr,
+                                              new_wlw=wlw_data.iloc[:0],
+                                              mapping_needed=False
+                                              )
+        drift_repeated = fitted_recommender_obj.update(
+            new_mastr=new_mastr, new_wlw=wlw_data.iloc[:0],
+            mapping_needed=False
+        )
+
+        scores = fitted_recommender_obj.pv_affinity_scores
+        assert scores.total_companies.sum() == total_before + 5
+        assert drift.new_companies.sum() == 5
+        assert (scores.percent == scores.mastr_data
+                / scores.total_companies).all()
+        assert drift_repeated.empty
+
+    def test_update_overlapping_frames(self, fitted_recommender_obj,
+                                       company_data):
+        mastr_data, wlw_data = company_data
+        new_mastr = mastr_data.iloc[:3].rename(
+            index=lambda icompany: f'new_{icompany}'
+        )
+        # new_mastr_0 is in both frames, only its Mastr values count
+        new_wlw = wlw_data.iloc[:2].set_axis(['new_mastr_0', 'new_wlw_1'])
+        scores_before = fitted_recommender_obj.pv_affinity_scores.copy()
+
+        drift = fitted_recommender_obj.update(new_mastr=new_mastr,
+                                              new_wlw=new_wlw,
+                                              mapping_needed=False
+                                              )
+
+        scores = fitted_recommender_obj.pv_affinity_scores
+        assert scores.total_companies.sum() == \
+            scores_before.total_companies.sum() + 4
+        assert scores.mastr_data.sum() == scores_before.mastr_data.sum() + 3
+        assert drift.new_companies.sum() == 4
+
+    def test_recommend_missing_product_categories(
+            self, fitted_recommender_obj, company_data):
+        _, wlw_data = company_data
+        company_data = wlw_data.iloc[:2].assign(
+            product_categories=parse_product_categories(
+                pd.Series(["{'Solartechnik'}", np.nan],
+                          index=wlw_data.index[:2])
+            )
+        )
+
+        pv_affinity, new_company = fitted_recommender_obj.recommend(
+            company_data, mapping_needed=False
+        )
+
+        assert list(pv_affinity.index) == list(wlw_data.index[:2])
+        assert 'product_categories' not in new_company.columns
+
+    def test__get_ordered_model(self, fitted_recommender_obj):
+        model = fitted_recommender_obj.model
+        obj_ut = fitted_recommender_obj._get_ordered_model()
+
+        assert fitted_recommender_obj._get_ordered_model() is obj_ut
+        np.testing.assert_allclose(np.sort(obj_ut[:, 2]),
+                                   np.sort(model[:, 2])
+                                   )
+        assert adjusted_rand_score(
+            fcluster(obj_ut, 0.5, criterion='distance'),
+            fcluster(model, 0.5, criterion='distance')
+        ) == 1
+
+    def test_fit_keeps_no_scaled_copy(self, fitted_recommender_obj):
+        assert fitted_recommender_obj.leaf_data is None
+        assert not hasattr(fitted_recommender_obj, 'scaled_ml')
+        np.testing.assert_allclose(
+            fitted_recommender_obj._scaled_features(),
+            fitted_recommender_obj.scaler.transform(
+                fitted_recommender_obj.ml_data.iloc[:, :-1]
+            )
+        )
+
+    def test_fit_single_micro_cluster(self, company_data):
+        mastr_data, wlw_data = company_data
+        mastr_data.loc[:, :] = 1.0
+        wlw_data.loc[:, :] = 1.0
+        obj_ut = recommender.Recommender()
+
+        with pytest.raises(ValueError, match='n_micro_clusters'):
+            obj_ut.fit(wlw_data=wlw_data, mastr_data=mastr_data,
+                       mapping_needed=False, n_micro_clusters=10,
+                       random_state=42
+                       )
+
+    def test_fit_optimal_ordering_labels(self, company_data):
+        mastr_data, wlw_data = company_data
+        obj_ut = recommender.Recommender()
+        obj_ut.cut_line = 0.5
+
+        obj_ut.fit(wlw_data=wlw_data.copy(), mastr_data=mastr_data.copy(),
+                   mapping_needed=False, optimal_ordering=True
+                   )
+
+        # labels of the eager ordering in scipy's linkage
+        expected = fcluster(linkage(obj_ut._scaled_features(), method='ward',
+                                    optimal_ordering=True),
+                            0.5, criterion='distance'
+                            )
+        np.testing.assert_array_equal(obj_ut.ml_data.labels.values,
+                                      expected)
+        assert list(obj_ut.label_averages.index) == \
+            sorted(np.unique(expected))
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pv_rec import scoring
+
+
+class TestCentroidScorer:
+    @pytest.fixture
+    def scorer_obj(self):
+        label_averages = pd.DataFrame([[0.0, 0.0], [1.0, 1.0], [0.0, 1.0]],
+                                      index=pd.Index([1, 2, 3], name='labels')
+                                      )
+        pv_affinity_scores = pd.DataFrame(
+            {'percent': [0.9, 0.1, 0.5]},
+            index=['cluster_2', 'cluster_1', 'cluster_3']
+        )
+        return scoring.CentroidScorer.from_recommender(label_averages,
+                                                       pv_affinity_scores
+                                                       )
+
+    def test_score(self, scorer_obj):
+        labels, affinities = scorer_obj.score([[0.1, 0.0],
+                                               [0.9, 1.0],
+                                               [0.1, 0.8]])
+
+        assert list(labels) == [1, 2, 3]
+        assert list(affinities) == [0.1, 0.9, 0.5]
+
+    def test_score_with_kd_tree(self, scorer_obj, monkeypatch):
+        monkeypatch.setattr(scoring.CentroidScorer, 'kd_tree_min_clusters', 1)
+        kd_scorer_obj = scoring.CentroidScorer(scorer_obj.centroids,
+                                               scorer_obj.affinities,
+                                               scorer_obj.cluster_labels
+                                               )
+        data = np.random.default_rng(42).random((100, 2))
+
+        assert (kd_scorer_obj.nearest_centroid(data)
+                == scorer_obj.nearest_centroid(data)).all()
+
+
+class TestScoringArtifact:
+    @pytest.fixture
+    def artifact_obj(self):
+        scorer = scoring.CentroidScorer([[0.0, 0.0], [1.0, 1.0]],
+                                        affinities=[0.2, 0.8],
+                                        cluster_labels=[1, 2]
+                                        )
+        return scoring.ScoringArtifact(columns=['employee_count',
+                                                'installed_power'],
+                                       scale=[0.5, 0.01],
+                                       min=[0.0, 0.0],
+                                       clip=False,
+                                       scorer=scorer,
+                                       ordinal_maps={
+                                           'employee_count':
+                                               scoring.ORDINAL_MAPS[
+                                                   'employee_count']
+                                       },
+                                       product_labels={'Solartechnik': 1}
+                                       )
+
+    def test_save_and_load(self, artifact_obj, tmp_path):
+        filepath = tmp_path / 'artifact.npz'
+        artifact_obj.save(filepath)
+
+        obj_ut = scoring.ScoringArtifact.load(filepath)
+
+        assert obj_ut.columns == artifact_obj.columns
+        assert obj_ut.product_labels == {'Solartechnik': 1}
+        assert obj_ut.ordinal_maps == artifact_obj.ordinal_maps
+        assert (obj_ut.scorer.centroids == artifact_obj.scorer.centroids).all()
+
+    def test_recommend(self, artifact_obj):
+        company_data = pd.DataFrame(
+            {'employee_count': ['unknown', '1-4', '5-9'],
+             'installed_power': [0.0, 100.0, np.nan]},
+            index=['company_a', 'company_b', 'company_c']
+        )
+
+        pv_affinity, new_company = artifact_obj.recommend(company_data)
+
+        assert list(new_company.labels) == [1, 2, 1]
+        assert list(pv_affinity.pv_affinity) == [0.2, 0.8, 0.2]
+
+    def test_recommend_skips_unknown_products(self, artifact_obj):
+        company_data = pd.DataFrame(
+            {'employee_count': ['1-4', '5-9'],
+             'installed_power': [100.0, 0.0],
+             'product_categories': [{'Solartechnik', 'Unbekannt'},
+                                    {'Unbekannt'}]},
+            index=['company_a', 'company_b']
+        )
+
+        pv_affinity, new_company = artifact_obj.recommend(company_data)
+
+        assert list(new_company.labels) == [2, 1]
+        assert list(pv_affinity.pv_affinity) == [0.8, 0.2]
+
+    def test_recommend_unknown_products_raise(self, artifact_obj):
+        company_data = pd.DataFrame(
+            {'employee_count': ['1-4'],
+             'installed_power': [100.0],
+             'product_categories': [{'Unbekannt'}]},
+            index=['company_a']
+        )
+
+        with pytest.raises(KeyError):
+            artifact_obj.recommend(company_data, skip_unknown=False)